@@ -0,0 +1,35 @@
+from django.utils import translation
+from drf_spectacular.views import SpectacularAPIView
+from rest_framework.response import Response
+
+
+class CachedSpectacularAPIView(SpectacularAPIView):
+    """
+    SpectacularAPIView that builds the schema once per process for each API
+    version and language, rather than re-walking every view on each request.
+    The schema only changes with a deploy, which restarts the process.
+    """
+
+    _schemas: dict[tuple, dict] = {}
+
+    def _get_schema_response(self, request):
+        version = self.api_version or request.version or self._get_version_parameter(request)
+        generator = self.generator_class(urlconf=self.urlconf, api_version=version, patterns=self.patterns)
+
+        # ?lang= is client input; only languages from settings.LANGUAGES get a cache slot,
+        # anything else is built per request so the cache stays bounded
+        try:
+            language = translation.get_supported_language_variant(translation.get_language())
+        except LookupError:
+            schema = generator.get_schema(request=request, public=self.serve_public)
+        else:
+            key = (version, language)
+            schema = self._schemas.get(key)
+            if schema is None:
+                schema = self._schemas[key] = generator.get_schema(request=request, public=self.serve_public)
+
+        return Response(
+            data=schema,
+            headers={"Content-Disposition": f'inline; filename="{self._get_filename(request, version)}"'},
+        )
+
@@ -1,6 +1,5 @@
 import os
 import warnings
-import stripe
 
 from pathlib import Path
 
@@ -244,10 +243,10 @@ STRIPE_PRICE_TO_FEATURES: dict[str, list[str]] = {
 
 # in seconds
 STRIPE_PRODUCT_CACHE_TTL = int(os.getenv("STRIPE_PRODUCT_CACHE_TTL", "300"))
+BILLING_STATUS_CACHE_TTL = int(os.getenv("BILLING_STATUS_CACHE_TTL", "30"))
 
-if STRIPE_SECRET_KEY:
-    stripe.api_key = STRIPE_SECRET_KEY
-else:
+# Stripe calls go through billing.stripe_client.get_stripe_client(); no global stripe.api_key
+if not STRIPE_SECRET_KEY:
     warnings.warn("No stripe secret key was provided; Stripe integration will not work.")
 
 
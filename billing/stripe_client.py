@@ -0,0 +1,13 @@
+import stripe
+from django.conf import settings
+
+_CLIENT = None
+
+
+def get_stripe_client() -> stripe.StripeClient:
+    # one client per process; its RequestsClient keeps a session (and its HTTPS connections)
+    # to api.stripe.com alive between calls, per thread
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = stripe.StripeClient(settings.STRIPE_SECRET_KEY)
+    return _CLIENT
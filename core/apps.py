@@ -1,5 +1,10 @@
+import logging
+import ssl
+
 from django.apps import AppConfig
 
+log = logging.getLogger("billing.core.apps")
+
 
 class CoreConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
@@ -7,8 +12,13 @@ class CoreConfig(AppConfig):
 
     def ready(self):
         # Explicit imports — each one registers handlers via __init_subclass__.
-        # 4 lines is a feature, not boilerplate. If any import fails,
+        # 5 lines is a feature, not boilerplate. If any import fails,
         # the app crashes at startup, not at 3am when a webhook arrives.
         import subscriptions.stripe_handlers  # noqa: F401
         import purchases.stripe_handlers      # noqa: F401
         import accounts.stripe_handlers       # noqa: F401
+        import payments.stripe_handlers       # noqa: F401
+
+        # webhook signature HMAC-SHA256 runs on hashlib's OpenSSL backend; SHA-NI / ARMv8 SHA2
+        # acceleration depends on this build, so record it to make slow deployments easy to spot
+        log.debug(f"hashlib backed by {ssl.OPENSSL_VERSION}")
@@ -80,18 +80,24 @@ class WebhookHandler:
             log.info(f"Dispatching {event_type} -> {name}")
 
             if handler.__atomic__:
+                # marked in the same transaction as the handler's writes, so a crash between
+                # the two can't leave them applied but unmarked and re-run on retry
                 with transaction.atomic():
                     handler.handle(data)
+                    cls._mark_processed(event_record, name)
             else:
                 handler.handle(data)
-
-            WebhookHandlerResult.objects.filter(
-                event=event_record,
-                handler_name=name,
-            ).update(processed=True, processed_at=timezone.now())
+                cls._mark_processed(event_record, name)
 
         return len(handlers)
 
+    @staticmethod
+    def _mark_processed(event_record, handler_name: str) -> None:
+        WebhookHandlerResult.objects.filter(
+            event=event_record,
+            handler_name=handler_name,
+        ).update(processed=True, processed_at=timezone.now())
+
     def __repr__(self):
         return f"{self.__class__.__name__}(event={self.__event__!r})"
 
@@ -2,13 +2,23 @@ from datetime import datetime, timezone
 from decimal import Decimal
 from typing import Optional
 
-from pydantic import BaseModel, Field, computed_field
+from pydantic import BaseModel, Field, TypeAdapter, computed_field
 
 
 def _ensure_datetime(ts: int) -> datetime:
     return datetime.fromtimestamp(ts, tz=timezone.utc)
 
 
+class StripeEventData(BaseModel):
+    object: dict
+
+
+class StripeEvent(BaseModel):
+    id: str
+    type: str
+    data: StripeEventData
+
+
 class StripePrice(BaseModel):
     id: str
 
@@ -84,10 +94,19 @@ class StripeInvoiceLines(BaseModel):
     data: list[StripeInvoiceLine] = Field(default_factory=list)
 
 
-class StripeInvoice(BaseModel):
+# validates lines.data on its own, once the caller knows it needs them
+StripeInvoiceLineList = TypeAdapter(list[StripeInvoiceLine])
+
+
+class StripeInvoiceHeader(BaseModel):
+    """An invoice without its lines; the raw lines payload is ignored, not parsed."""
+
     id: str
     customer: str
     billing_reason: Optional[str] = None
+
+
+class StripeInvoice(StripeInvoiceHeader):
     lines: StripeInvoiceLines = Field(default_factory=StripeInvoiceLines)
 
 
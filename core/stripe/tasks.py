@@ -5,8 +5,13 @@ import stripe
 from celery import shared_task
 from django.conf import settings
 from django.core.mail import send_mail
+from django.db.models import F
 from django.utils import timezone
 
+from billing.stripe_client import get_stripe_client
+from core.exceptions import WebhookSkip
+from core.stripe.event_handler import dispatch_event
+from core.stripe.models import StripeSubscription
 from subscriptions.models import Subscription, SubscriptionStatus
 
 log = logging.getLogger("billing.core.stripe.tasks")
@@ -24,7 +29,7 @@ def process_subscription_lifecycle(self):
     active_subs = Subscription.objects.filter(
         status__in=[SubscriptionStatus.ACTIVE, SubscriptionStatus.TRIALING],
         cancel_at_period_end=True,
-    ).select_related("customer", "customer__user")
+    ).with_owner()
 
     for sub in active_subs:
         days_until_end = (sub.current_period_end.date() - today).days
@@ -37,7 +42,7 @@ def process_subscription_lifecycle(self):
     past_due_subs = Subscription.objects.filter(
         status=SubscriptionStatus.PAST_DUE,
         current_period_end__lt=grace_cutoff,
-    ).select_related("customer", "customer__user")
+    ).with_owner()
 
     for sub in past_due_subs:
         _expire_subscription(sub)
@@ -106,12 +111,36 @@ def sync_stale_subscriptions_from_stripe(self):
     synced = 0
     for sub in stale_subs:
         try:
-            stripe_sub = stripe.Subscription.retrieve(sub.stripe_subscription_id)
+            stripe_sub = get_stripe_client().subscriptions.retrieve(sub.stripe_subscription_id)
             sub.status = stripe_sub.status
             sub.cancel_at_period_end = stripe_sub.cancel_at_period_end
-            sub.save(update_fields=["status", "cancel_at_period_end", "updated_at"])
+            sub.version = F("version") + 1
+            sub.save(update_fields=["status", "cancel_at_period_end", "version", "updated_at"])
             synced += 1
         except stripe.StripeError as e:
             log.error(f"Failed to sync subscription {sub.stripe_subscription_id} from Stripe: {e}")
 
     log.info(f"Synced {synced} stale subscriptions from Stripe")
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def refresh_subscription_from_stripe(self, stripe_subscription_id: str, event_type: str):
+    """
+    Re-run event_type's handlers with the full subscription from Stripe, for
+    webhooks that arrived without period fields and had nothing stored to fall back on.
+    """
+    try:
+        data = get_stripe_client().subscriptions.retrieve(stripe_subscription_id).to_dict()
+    except stripe.StripeError as exc:
+        log.warning(f"Failed to fetch subscription {stripe_subscription_id} from Stripe: {exc}")
+        raise self.retry(exc=exc)
+
+    # the handlers would defer straight back here
+    if StripeSubscription.model_validate(data).current_period_start is None:
+        log.error(f"Subscription {stripe_subscription_id} has no period data even after fetch")
+        return
+
+    try:
+        dispatch_event(event_type, data)
+    except WebhookSkip as e:
+        log.info(f"Skipped refreshed {event_type} for {stripe_subscription_id}: {e}")
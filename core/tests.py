@@ -1,3 +1,4 @@
+import json
 from datetime import timedelta
 from decimal import Decimal
 from unittest.mock import patch, MagicMock
@@ -7,7 +8,7 @@ from django.utils import timezone
 
 from core.models import WebhookEvent, WebhookHandlerResult, ScheduledEvent, EventType
 from core.stripe import WebhookHandler, dispatch_event
-from core.stripe.models import StripeSubscription, StripeInvoice, StripeCharge, _ensure_datetime
+from core.stripe.models import StripeSubscription, StripeInvoice, StripeInvoiceHeader, StripeCharge, _ensure_datetime
 from core.views import health_check
 
 
@@ -54,6 +55,15 @@ class StripeInvoiceModelTest(TestCase):
         self.assertEqual(inv.lines.data[0].amount_dollars, Decimal("29.99"))
         self.assertEqual(inv.lines.data[0].price_id, "price_pro")
 
+    def test_header_ignores_lines(self):
+        inv = StripeInvoiceHeader.model_validate({
+            "id": "in_test",
+            "customer": "cus_test",
+            "lines": {"data": [{"description": "missing amount"}]},
+        })
+        self.assertEqual(inv.id, "in_test")
+        self.assertFalse(hasattr(inv, "lines"))
+
 
 class StripeChargeModelTest(TestCase):
 
@@ -203,6 +213,28 @@ class TrackedDispatchTest(TestCase):
 
         WebhookHandler.__handlers__["test.tracked.skip"].remove(_TrackedSkip)
 
+    def test_atomic_handler_writes_roll_back_if_not_marked(self):
+        class _TrackedAtomic(WebhookHandler):
+            __event__ = "test.tracked.atomic"
+
+            @classmethod
+            def handle(cls, data: dict):
+                WebhookEvent.objects.create(stripe_event_id="evt_side_effect", event_type="x", payload={})
+
+        event = WebhookEvent.objects.create(
+            stripe_event_id="evt_tracked_atomic",
+            event_type="test.tracked.atomic",
+            payload={},
+        )
+
+        with patch.object(WebhookHandler, "_mark_processed", side_effect=RuntimeError("db gone")):
+            with self.assertRaises(RuntimeError):
+                WebhookHandler.dispatch_tracked(event, "test.tracked.atomic", {})
+
+        self.assertFalse(WebhookEvent.objects.filter(stripe_event_id="evt_side_effect").exists())
+
+        WebhookHandler.__handlers__["test.tracked.atomic"].remove(_TrackedAtomic)
+
 
 class HealthCheckViewTest(TestCase):
 
@@ -217,7 +249,7 @@ class HealthCheckViewTest(TestCase):
         request = self.factory.get("/api/health/")
         response = health_check(request)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data["status"], "healthy")
+        self.assertEqual(json.loads(response.content)["status"], "healthy")
 
     @patch("core.views._check_database", return_value=None)
     @patch("core.views._check_redis", return_value="connection refused")
@@ -227,14 +259,66 @@ class HealthCheckViewTest(TestCase):
         request = self.factory.get("/api/health/")
         response = health_check(request)
         self.assertEqual(response.status_code, 503)
-        self.assertEqual(response.data["status"], "down")
-        self.assertEqual(response.data["service_details"]["redis"], "connection refused")
+        body = json.loads(response.content)
+        self.assertEqual(body["status"], "down")
+        self.assertEqual(body["service_details"]["redis"], "connection refused")
+
+    def test_rejects_non_get(self):
+        request = self.factory.post("/api/health/")
+        response = health_check(request)
+        self.assertEqual(response.status_code, 405)
+
+
+class SchemaViewTest(TestCase):
+
+    def setUp(self):
+        from billing.schema import CachedSpectacularAPIView
+
+        CachedSpectacularAPIView._schemas.clear()
+
+    def test_schema_is_generated_once_per_process(self):
+        from drf_spectacular.generators import SchemaGenerator
+
+        with patch.object(SchemaGenerator, "get_schema", autospec=True, side_effect=SchemaGenerator.get_schema) as get_schema:
+            first = self.client.get("/api/schema/", HTTP_ACCEPT="application/vnd.oai.openapi+json")
+            second = self.client.get("/api/schema/")
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(get_schema.call_count, 1)
+        self.assertIn("/api/subscriptions/me/", json.loads(first.content)["paths"])
+
+    def test_plain_health_view_is_documented(self):
+        response = self.client.get("/api/schema/", HTTP_ACCEPT="application/vnd.oai.openapi+json")
+        schema = json.loads(response.content)
+
+        operation = schema["paths"]["/api/health/"]["get"]
+        self.assertEqual(operation["tags"], ["Health"])
+        self.assertEqual(set(operation["responses"]), {"200", "503"})
+        self.assertIn("/api/v1/health/", schema["paths"])
+        self.assertIn("HealthCheckResponse", schema["components"]["schemas"])
+
+    def test_unsupported_lang_is_not_cached(self):
+        from billing.schema import CachedSpectacularAPIView
+
+        for lang in ("zz3", "zz4"):
+            response = self.client.get("/api/schema/", {"lang": lang})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(CachedSpectacularAPIView._schemas, {})
+
+        # regional variants share their supported language's entry
+        self.client.get("/api/schema/", {"lang": "de"})
+        self.client.get("/api/schema/", {"lang": "de-xx"})
+        self.assertEqual(len(CachedSpectacularAPIView._schemas), 1)
 
 
 class StripeWebhookViewTest(TestCase):
 
     def setUp(self):
+        from core.views import _RECENT_EVENT_IDS
+
         self.factory = RequestFactory()
+        _RECENT_EVENT_IDS.clear()
 
     def test_missing_signature_returns_400(self):
         from core.views import stripe_webhook
@@ -250,7 +334,7 @@ class StripeWebhookViewTest(TestCase):
         self.assertEqual(response.data["error"], "Missing Stripe-Signature header")
 
     @patch("core.tasks.process_webhook_event.delay")
-    @patch("core.views.stripe.Webhook.construct_event")
+    @patch("core.views._construct_event")
     def test_duplicate_event_returns_200(self, mock_construct, mock_delay):
         from core.views import stripe_webhook
 
@@ -277,7 +361,7 @@ class StripeWebhookViewTest(TestCase):
         mock_delay.assert_not_called()
 
     @patch("core.tasks.process_webhook_event.delay")
-    @patch("core.views.stripe.Webhook.construct_event")
+    @patch("core.views._construct_event")
     def test_valid_event_stores_and_enqueues(self, mock_construct, mock_delay):
         from core.views import stripe_webhook
 
@@ -293,7 +377,8 @@ class StripeWebhookViewTest(TestCase):
             content_type="application/json",
             HTTP_STRIPE_SIGNATURE="test_sig",
         )
-        response = stripe_webhook(request)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = stripe_webhook(request)
         self.assertEqual(response.status_code, 200)
 
         event = WebhookEvent.objects.get(stripe_event_id="evt_new")
@@ -324,6 +409,62 @@ class CleanupWebhookEventsTest(TestCase):
         self.assertTrue(WebhookEvent.objects.filter(pk=recent.pk).exists())
 
 
+class RefreshSubscriptionFromStripeTest(TestCase):
+
+    @patch("core.stripe.tasks.get_stripe_client")
+    def test_redispatches_with_fetched_subscription(self, get_client):
+        from core.stripe.tasks import refresh_subscription_from_stripe
+        from subscriptions.models import Subscription
+        from testing_utils import make_customer, make_stripe_subscription_data
+
+        make_customer(stripe_customer_id="cus_refresh")
+        full = make_stripe_subscription_data(sub_id="sub_refresh", customer_id="cus_refresh")
+        get_client.return_value.subscriptions.retrieve.return_value.to_dict.return_value = full
+
+        refresh_subscription_from_stripe("sub_refresh", "customer.subscription.created")
+
+        get_client.return_value.subscriptions.retrieve.assert_called_once_with("sub_refresh")
+        self.assertTrue(Subscription.objects.filter(stripe_subscription_id="sub_refresh").exists())
+
+    @patch("core.stripe.tasks.dispatch_event")
+    @patch("core.stripe.tasks.get_stripe_client")
+    def test_gives_up_when_stripe_has_no_period_data(self, get_client, dispatch):
+        from core.stripe.tasks import refresh_subscription_from_stripe
+        from testing_utils import make_stripe_subscription_data
+
+        full = make_stripe_subscription_data(sub_id="sub_refresh_bare")
+        full.update(current_period_start=None, current_period_end=None)
+        get_client.return_value.subscriptions.retrieve.return_value.to_dict.return_value = full
+
+        refresh_subscription_from_stripe("sub_refresh_bare", "customer.subscription.created")
+
+        dispatch.assert_not_called()
+
+
+class SyncStaleSubscriptionsTest(TestCase):
+
+    @override_settings(STRIPE_SECRET_KEY="sk_test_sync")
+    @patch("core.stripe.tasks.get_stripe_client")
+    def test_syncs_through_client_and_bumps_version(self, get_client):
+        from core.stripe.tasks import sync_stale_subscriptions_from_stripe
+        from subscriptions.models import Subscription, SubscriptionStatus
+        from testing_utils import make_customer, make_subscription
+
+        sub = make_subscription(customer=make_customer(), stripe_subscription_id="sub_stale")
+        Subscription.objects.filter(pk=sub.pk).update(updated_at=timezone.now() - timedelta(days=3))
+        get_client.return_value.subscriptions.retrieve.return_value = MagicMock(
+            status=SubscriptionStatus.PAST_DUE, cancel_at_period_end=True,
+        )
+
+        sync_stale_subscriptions_from_stripe()
+
+        get_client.return_value.subscriptions.retrieve.assert_called_once_with("sub_stale")
+        sub.refresh_from_db()
+        self.assertEqual(sub.status, SubscriptionStatus.PAST_DUE)
+        self.assertTrue(sub.cancel_at_period_end)
+        self.assertEqual(sub.version, 1)
+
+
 class ProcessScheduledEventsTest(TestCase):
 
     def test_processes_due_events(self):
@@ -1,11 +1,17 @@
 from decimal import Decimal
+from unittest.mock import patch
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from accounts.models import Customer
 from core.exceptions import WebhookSkip, WebhookRetry
 from subscriptions.models import Subscription, SubscriptionStatus
 from entitlement.models import Entitlement
+from payments.services import purchase_history_cache_key
 from purchases.models import Purchase, PurchaseStatus
 
 from subscriptions.stripe_handlers import (
@@ -21,6 +27,7 @@ from purchases.stripe_handlers import (
     HandleChargeRefunded,
     HandleChargeDisputeCreated,
     HandlePaymentIntentFailed,
+    customer_ids_cache_key,
 )
 from accounts.stripe_handlers import HandleCustomerUpdated
 from testing_utils import (
@@ -66,11 +73,36 @@ class HandleSubscriptionCreatedTest(TestCase):
         HandleSubscriptionCreated.handle(data)
         self.assertEqual(Subscription.objects.filter(stripe_subscription_id="sub_idem").count(), 1)
 
+    def test_redelivery_bumps_version(self):
+        make_customer(stripe_customer_id="cus_idem_ver")
+        data = make_stripe_subscription_data(sub_id="sub_idem_ver", customer_id="cus_idem_ver")
+        HandleSubscriptionCreated.handle(data)
+        self.assertEqual(Subscription.objects.get(stripe_subscription_id="sub_idem_ver").version, 0)
+
+        data["status"] = "past_due"
+        HandleSubscriptionCreated.handle(data)
+
+        sub = Subscription.objects.get(stripe_subscription_id="sub_idem_ver")
+        self.assertEqual(sub.status, SubscriptionStatus.PAST_DUE)
+        self.assertEqual(sub.version, 1)
+
     def test_raises_webhook_retry_on_unknown_customer(self):
         data = make_stripe_subscription_data(customer_id="cus_unknown")
         with self.assertRaises(WebhookRetry):
             HandleSubscriptionCreated.handle(data)
 
+    @patch("subscriptions.stripe_handlers.refresh_subscription_from_stripe")
+    def test_defers_stripe_fetch_when_period_fields_missing(self, refresh):
+        make_customer(stripe_customer_id="cus_noperiod")
+        data = make_stripe_subscription_data(sub_id="sub_noperiod", customer_id="cus_noperiod")
+        data.update(current_period_start=None, current_period_end=None)
+
+        with self.assertRaises(WebhookSkip):
+            HandleSubscriptionCreated.handle(data)
+
+        refresh.delay.assert_called_once_with("sub_noperiod", "customer.subscription.created")
+        self.assertFalse(Subscription.objects.filter(stripe_subscription_id="sub_noperiod").exists())
+
 
 class HandleSubscriptionUpdatedTest(TestCase):
 
@@ -87,6 +119,38 @@ class HandleSubscriptionUpdatedTest(TestCase):
         sub.refresh_from_db()
         self.assertEqual(sub.stripe_price_id, "price_basic_monthly")
 
+    def test_only_writes_changed_columns(self):
+        customer = make_customer(stripe_customer_id="cus_upd_cols")
+        sub = make_subscription(customer=customer, stripe_subscription_id="sub_upd_cols")
+        data = make_stripe_subscription_data(
+            sub_id="sub_upd_cols", customer_id="cus_upd_cols",
+            price_id="price_basic_monthly", status="active",
+        )
+        HandleSubscriptionUpdated.handle(data)
+
+        with CaptureQueriesContext(connection) as ctx:
+            HandleSubscriptionUpdated.handle({**data, "cancel_at_period_end": True})
+        updates = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith('UPDATE "subscriptions"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"cancel_at_period_end"', updates[0])
+        self.assertNotIn('"stripe_price_id"', updates[0])
+
+        sub.refresh_from_db()
+        self.assertTrue(sub.cancel_at_period_end)
+
+    def test_skips_save_when_nothing_changed(self):
+        customer = make_customer(stripe_customer_id="cus_upd_noop")
+        make_subscription(customer=customer, stripe_subscription_id="sub_upd_noop")
+        data = make_stripe_subscription_data(
+            sub_id="sub_upd_noop", customer_id="cus_upd_noop",
+            price_id="price_basic_monthly", status="active",
+        )
+        HandleSubscriptionUpdated.handle(data)
+
+        with CaptureQueriesContext(connection) as ctx:
+            HandleSubscriptionUpdated.handle(data)
+        self.assertFalse(any(q["sql"].startswith('UPDATE "subscriptions"') for q in ctx.captured_queries))
+
     def test_revokes_entitlements_on_cancel(self):
         customer = make_customer(stripe_customer_id="cus_cancel")
         sub = make_subscription(customer=customer, stripe_subscription_id="sub_cancel")
@@ -101,6 +165,23 @@ class HandleSubscriptionUpdatedTest(TestCase):
         self.assertEqual(sub.status, "canceled")
         self.assertEqual(Entitlement.objects.filter(subscription=sub, is_active=True).count(), 0)
 
+    @patch("subscriptions.stripe_handlers.refresh_subscription_from_stripe")
+    def test_missing_period_fields_fall_back_to_stored_row(self, refresh):
+        customer = make_customer(stripe_customer_id="cus_upd_noperiod")
+        sub = make_subscription(customer=customer, stripe_subscription_id="sub_upd_noperiod")
+        stored_end = sub.current_period_end.replace(microsecond=0)
+
+        data = make_stripe_subscription_data(
+            sub_id="sub_upd_noperiod", customer_id="cus_upd_noperiod", price_id="price_basic_monthly",
+        )
+        data.update(current_period_start=None, current_period_end=None)
+        HandleSubscriptionUpdated.handle(data)
+
+        refresh.delay.assert_not_called()
+        sub.refresh_from_db()
+        self.assertEqual(sub.stripe_price_id, "price_basic_monthly")
+        self.assertEqual(sub.current_period_end, stored_end)
+
     def test_raises_webhook_skip_for_unknown_subscription(self):
         data = make_stripe_subscription_data(sub_id="sub_nonexistent")
         with self.assertRaises(WebhookSkip):
@@ -131,13 +212,137 @@ class HandleSubscriptionPausedTest(TestCase):
         Entitlement.objects.create(customer=customer, subscription=sub, feature="api_access")
 
         data = make_stripe_subscription_data(sub_id="sub_pause", customer_id="cus_pause")
-        HandleSubscriptionPaused.handle(data)
+        # guarded status UPDATE ... RETURNING, entitlement revoke COUNT + UPDATE
+        with self.assertNumQueries(3):
+            HandleSubscriptionPaused.handle(data)
 
         sub.refresh_from_db()
         self.assertEqual(sub.status, SubscriptionStatus.PAUSED)
         self.assertIsNotNone(sub.paused_at)
         self.assertEqual(Entitlement.objects.filter(subscription=sub, is_active=True).count(), 0)
 
+    def test_invalidates_billing_status_after_commit(self):
+        customer = make_customer(stripe_customer_id="cus_pause_inv")
+        make_subscription(customer=customer, stripe_subscription_id="sub_pause_inv")
+
+        data = make_stripe_subscription_data(sub_id="sub_pause_inv", customer_id="cus_pause_inv")
+        with patch("subscriptions.stripe_handlers.invalidate_billing_status") as invalidate:
+            with self.captureOnCommitCallbacks(execute=True):
+                HandleSubscriptionPaused.handle(data)
+        invalidate.assert_called_once_with(customer.user_id)
+
+    def test_applies_unexpected_transition_with_warning(self):
+        customer = make_customer(stripe_customer_id="cus_pause_odd")
+        sub = make_subscription(
+            customer=customer,
+            stripe_subscription_id="sub_pause_odd",
+            status=SubscriptionStatus.UNPAID,
+        )
+
+        data = make_stripe_subscription_data(sub_id="sub_pause_odd", customer_id="cus_pause_odd")
+        with self.assertLogs("billing.subscriptions", level="WARNING"):
+            HandleSubscriptionPaused.handle(data)
+
+        sub.refresh_from_db()
+        self.assertEqual(sub.status, SubscriptionStatus.PAUSED)
+        self.assertIsNotNone(sub.paused_at)
+
+    def test_bumps_version(self):
+        customer = make_customer(stripe_customer_id="cus_pause_ver")
+        sub = make_subscription(customer=customer, stripe_subscription_id="sub_pause_ver")
+
+        data = make_stripe_subscription_data(sub_id="sub_pause_ver", customer_id="cus_pause_ver")
+        HandleSubscriptionPaused.handle(data)
+
+        sub.refresh_from_db()
+        self.assertEqual(sub.version, 1)
+
+    def test_unexpected_transition_retries_on_concurrent_write(self):
+        customer = make_customer(stripe_customer_id="cus_pause_race")
+        sub = make_subscription(
+            customer=customer,
+            stripe_subscription_id="sub_pause_race",
+            status=SubscriptionStatus.UNPAID,
+        )
+        original_apply = Subscription.apply_new_status
+        calls = []
+
+        def apply_with_concurrent_write(instance, new_status):
+            calls.append(new_status)
+            if len(calls) == 1:
+                # another worker writes between our read and our guarded UPDATE
+                Subscription.objects.filter(pk=sub.pk).update(version=F("version") + 1)
+            original_apply(instance, new_status)
+
+        data = make_stripe_subscription_data(sub_id="sub_pause_race", customer_id="cus_pause_race")
+        with patch.object(Subscription, "apply_new_status", apply_with_concurrent_write):
+            HandleSubscriptionPaused.handle(data)
+
+        self.assertEqual(len(calls), 2)
+        sub.refresh_from_db()
+        self.assertEqual(sub.status, SubscriptionStatus.PAUSED)
+        self.assertEqual(sub.version, 2)
+
+    def test_unexpected_transition_retries_on_concurrent_redelivery(self):
+        customer = make_customer(stripe_customer_id="cus_pause_redeliver")
+        sub = make_subscription(
+            customer=customer,
+            stripe_subscription_id="sub_pause_redeliver",
+            status=SubscriptionStatus.UNPAID,
+        )
+        original_apply = Subscription.apply_new_status
+        seen = []
+
+        def apply_with_concurrent_redelivery(instance, new_status):
+            seen.append(instance.status)
+            if len(seen) == 1:
+                # a created redelivery (not a transition) lands between our read and our guarded UPDATE
+                HandleSubscriptionCreated.handle(make_stripe_subscription_data(
+                    sub_id="sub_pause_redeliver", customer_id="cus_pause_redeliver", status="past_due",
+                ))
+            original_apply(instance, new_status)
+
+        data = make_stripe_subscription_data(sub_id="sub_pause_redeliver", customer_id="cus_pause_redeliver")
+        with patch.object(Subscription, "apply_new_status", apply_with_concurrent_redelivery):
+            HandleSubscriptionPaused.handle(data)
+
+        # the second attempt re-read the redelivered status instead of writing over it blind
+        self.assertEqual(seen, [SubscriptionStatus.UNPAID, SubscriptionStatus.PAST_DUE])
+        sub.refresh_from_db()
+        self.assertEqual(sub.status, SubscriptionStatus.PAUSED)
+        self.assertEqual(sub.version, 2)
+
+    def test_unexpected_transition_retries_on_concurrent_model_write(self):
+        for method, written in (("cancel", SubscriptionStatus.CANCELED), ("pause", SubscriptionStatus.PAUSED)):
+            with self.subTest(method=method):
+                sub = make_subscription(
+                    customer=make_customer(stripe_customer_id=f"cus_pause_{method}"),
+                    stripe_subscription_id=f"sub_pause_{method}",
+                    status=SubscriptionStatus.UNPAID,
+                )
+                # loaded before the webhook and never locked, like _expire_subscription's instance,
+                # then written by someone else, so its loaded version is already behind
+                stale = Subscription.objects.get(pk=sub.pk)
+                Subscription.objects.filter(pk=sub.pk).update(version=F("version") + 1)
+                original_apply = Subscription.apply_new_status
+                seen = []
+
+                def apply_with_concurrent_write(instance, new_status):
+                    if instance is not stale:
+                        seen.append(instance.status)
+                        if len(seen) == 1:
+                            getattr(stale, method)()
+                    original_apply(instance, new_status)
+
+                data = make_stripe_subscription_data(sub_id=f"sub_pause_{method}", customer_id=f"cus_pause_{method}")
+                with patch.object(Subscription, "apply_new_status", apply_with_concurrent_write):
+                    HandleSubscriptionPaused.handle(data)
+
+                self.assertEqual(seen, [SubscriptionStatus.UNPAID, written])
+                sub.refresh_from_db()
+                self.assertEqual(sub.status, SubscriptionStatus.PAUSED)
+                self.assertEqual(sub.version, 3)
+
     def test_raises_webhook_skip_for_unknown_subscription(self):
         data = make_stripe_subscription_data(sub_id="sub_unknown_pause")
         with self.assertRaises(WebhookSkip):
@@ -159,7 +364,10 @@ class HandleSubscriptionResumedTest(TestCase):
             sub_id="sub_resume", customer_id="cus_resume",
             price_id="price_pro_monthly", status="active",
         )
-        HandleSubscriptionResumed.handle(data)
+        # guarded UPDATE ... RETURNING, then entitlement sync (savepoint, SELECT, INSERT, reactivate UPDATE);
+        # nothing lazy-loads off the partially loaded row
+        with self.assertNumQueries(6):
+            HandleSubscriptionResumed.handle(data)
 
         sub.refresh_from_db()
         self.assertEqual(sub.status, SubscriptionStatus.ACTIVE)
@@ -178,8 +386,13 @@ class HandleSubscriptionResumedTest(TestCase):
             HandleSubscriptionResumed.handle(data)
 
 
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
 class HandleInvoicePaidTest(TestCase):
 
+    def setUp(self):
+        # pks are reused across rolled-back tests; don't let a cached mapping leak between them
+        cache.clear()
+
     def test_creates_purchase(self):
         customer = make_customer(stripe_customer_id="cus_inv")
         data = make_stripe_invoice_data(
@@ -205,9 +418,32 @@ class HandleInvoicePaidTest(TestCase):
         HandleInvoicePaid.handle(data)
         self.assertEqual(Purchase.objects.count(), 0)
 
+    def test_repeat_customer_lookup_is_cached(self):
+        make_customer(stripe_customer_id="cus_hot")
+        HandleInvoicePaid.handle(make_stripe_invoice_data(invoice_id="in_hot_1", customer_id="cus_hot"))
 
+        # just the upsert; the customer comes from the cache
+        with self.assertNumQueries(1):
+            HandleInvoicePaid.handle(make_stripe_invoice_data(invoice_id="in_hot_2", customer_id="cus_hot"))
+
+    def test_customer_delete_drops_cached_ids(self):
+        customer = make_customer(stripe_customer_id="cus_gone")
+        HandleInvoicePaid.handle(make_stripe_invoice_data(invoice_id="in_gone_1", customer_id="cus_gone"))
+        self.assertIsNotNone(cache.get(customer_ids_cache_key("cus_gone")))
+
+        Purchase.objects.filter(customer=customer).delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            customer.delete()
+
+        self.assertIsNone(cache.get(customer_ids_cache_key("cus_gone")))
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
 class HandleCheckoutSessionCompletedTest(TestCase):
 
+    def setUp(self):
+        cache.clear()
+
     def test_creates_one_time_purchase(self):
         customer = make_customer(stripe_customer_id="cus_checkout")
         data = make_stripe_checkout_session_data(
@@ -297,6 +533,24 @@ class HandleChargeRefundedTest(TestCase):
         purchase = Purchase.objects.get(stripe_invoice_id="in_refund")
         self.assertEqual(purchase.status, PurchaseStatus.REFUNDED)
 
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_invalidates_purchase_history(self):
+        cache.clear()
+        customer = make_customer(stripe_customer_id="cus_ref_cache")
+        Purchase.objects.create(
+            customer=customer, purchase_type="one_time",
+            amount=Decimal("29.99"), product_name="Pro",
+            stripe_price_id="price_pro", stripe_invoice_id="in_refund_cache",
+        )
+        key = purchase_history_cache_key(customer.user_id)
+        cache.set(key, [{"status": PurchaseStatus.PAID}])
+
+        data = make_stripe_charge_data(invoice_id="in_refund_cache", amount_refunded=2999)
+        with self.captureOnCommitCallbacks(execute=True):
+            HandleChargeRefunded.handle(data)
+
+        self.assertIsNone(cache.get(key))
+
     def test_skips_charge_without_invoice(self):
         data = {"id": "ch_noinv", "invoice": None, "amount_refunded": 0}
         HandleChargeRefunded.handle(data)
@@ -348,6 +602,27 @@ class HandleChargeDisputeCreatedTest(TestCase):
         self.assertEqual(purchase.status, PurchaseStatus.DISPUTED)
         self.assertEqual(purchase.dispute_reason, "product_not_received")
 
+    def test_charge_match_wins_in_a_single_lookup(self):
+        customer = make_customer(stripe_customer_id="cus_disp_both")
+        by_charge = Purchase.objects.create(
+            customer=customer, purchase_type="one_time",
+            amount=Decimal("10.00"), product_name="Old",
+            stripe_charge_id="ch_both",
+        )
+        Purchase.objects.create(
+            customer=customer, purchase_type="one_time",
+            amount=Decimal("20.00"), product_name="Newer",
+            stripe_payment_intent_id="pi_both",
+        )
+
+        data = make_stripe_dispute_data(charge_id="ch_both", payment_intent="pi_both")
+        with self.assertNumQueries(2):
+            HandleChargeDisputeCreated.handle(data)
+
+        by_charge.refresh_from_db()
+        self.assertEqual(by_charge.status, PurchaseStatus.DISPUTED)
+        self.assertEqual(Purchase.objects.filter(status=PurchaseStatus.DISPUTED).count(), 1)
+
     def test_raises_webhook_skip_when_no_purchase_found(self):
         data = make_stripe_dispute_data(
             charge_id="ch_ghost", payment_intent="pi_ghost",
@@ -16,6 +16,7 @@ from django.test import TestCase, override_settings
 from rest_framework.test import APIClient
 
 from core.models import WebhookEvent
+from core.views import _RECENT_EVENT_IDS
 from testing_utils import make_customer, make_stripe_subscription_data
 
 
@@ -36,10 +37,11 @@ def _make_stripe_signature(payload: bytes, secret: str = WEBHOOK_SECRET) -> str:
 
 @override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
 class WebhookEndpointIntegrationTest(TestCase):
+    client_class = APIClient
 
     def setUp(self):
-        self.client = APIClient()
         self.url = "/api/webhooks/stripe/"
+        _RECENT_EVENT_IDS.clear()
 
     def test_rejects_missing_signature(self):
         response = self.client.post(self.url, data=b"{}", content_type="application/json")
@@ -56,7 +58,7 @@ class WebhookEndpointIntegrationTest(TestCase):
         self.assertEqual(response.status_code, 400)
 
     @patch("core.tasks.process_webhook_event.delay")
-    @patch("core.views.stripe.Webhook.construct_event")
+    @patch("core.views._construct_event")
     def test_returns_200_and_enqueues_task(self, mock_construct, mock_delay):
         make_customer(stripe_customer_id="cus_int_test")
         sub_data = make_stripe_subscription_data(
@@ -72,12 +74,13 @@ class WebhookEndpointIntegrationTest(TestCase):
         mock_event.data.object = sub_data
         mock_construct.return_value = mock_event
 
-        response = self.client.post(
-            self.url,
-            data=b"{}",
-            content_type="application/json",
-            HTTP_STRIPE_SIGNATURE="t=123,v1=test",
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url,
+                data=b"{}",
+                content_type="application/json",
+                HTTP_STRIPE_SIGNATURE="t=123,v1=test",
+            )
 
         self.assertEqual(response.status_code, 200)
 
@@ -91,7 +94,7 @@ class WebhookEndpointIntegrationTest(TestCase):
         mock_delay.assert_called_once_with("evt_success")
 
     @patch("core.tasks.process_webhook_event.delay")
-    @patch("core.views.stripe.Webhook.construct_event")
+    @patch("core.views._construct_event")
     def test_returns_200_for_duplicate_event(self, mock_construct, mock_delay):
         WebhookEvent.objects.create(
             stripe_event_id="evt_dup",
@@ -102,6 +105,7 @@ class WebhookEndpointIntegrationTest(TestCase):
         mock_event = MagicMock()
         mock_event.id = "evt_dup"
         mock_event.type = "test"
+        mock_event.data.object = {}
         mock_construct.return_value = mock_event
 
         response = self.client.post(
@@ -116,7 +120,7 @@ class WebhookEndpointIntegrationTest(TestCase):
         mock_delay.assert_not_called()
 
     @patch("core.tasks.process_webhook_event.delay")
-    @patch("core.views.stripe.Webhook.construct_event")
+    @patch("core.views._construct_event")
     def test_stores_payload_for_later_processing(self, mock_construct, mock_delay):
         """
         The key architectural change: the view stores the event payload
@@ -143,6 +147,59 @@ class WebhookEndpointIntegrationTest(TestCase):
         self.assertFalse(event.processed)
 
 
+    @patch("core.tasks.process_webhook_event.delay")
+    def test_accepts_validly_signed_event(self, mock_delay):
+        payload = json.dumps({
+            "id": "evt_signed",
+            "type": "invoice.paid",
+            "data": {"object": {"id": "in_signed", "amount_paid": 2999}},
+        }).encode("utf-8")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.url,
+                data=payload,
+                content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=_make_stripe_signature(payload),
+            )
+
+        self.assertEqual(response.status_code, 200)
+        event = WebhookEvent.objects.get(stripe_event_id="evt_signed")
+        self.assertEqual(event.event_type, "invoice.paid")
+        self.assertEqual(event.payload, {"id": "in_signed", "amount_paid": 2999})
+        mock_delay.assert_called_once_with("evt_signed")
+
+    @patch("core.tasks.process_webhook_event.delay")
+    def test_recent_duplicate_skips_database(self, mock_delay):
+        payload = json.dumps({
+            "id": "evt_retry_burst",
+            "type": "invoice.paid",
+            "data": {"object": {"id": "in_burst"}},
+        }).encode("utf-8")
+        signature = _make_stripe_signature(payload)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.url, data=payload, content_type="application/json", HTTP_STRIPE_SIGNATURE=signature)
+
+        with self.assertNumQueries(0):
+            response = self.client.post(
+                self.url, data=payload, content_type="application/json", HTTP_STRIPE_SIGNATURE=signature,
+            )
+
+        self.assertEqual(response.status_code, 200)
+        mock_delay.assert_called_once_with("evt_retry_burst")
+
+    def test_rejects_signed_payload_that_is_not_an_event(self):
+        payload = b'{"unexpected": true}'
+        response = self.client.post(
+            self.url,
+            data=payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=_make_stripe_signature(payload),
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["error"], "Invalid payload")
+
 @override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
 class ProcessWebhookEventTaskTest(TestCase):
     """Tests the Celery task that processes stored events."""
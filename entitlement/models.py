@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Now
 from django.utils import timezone
 
 from accounts.models import Customer
@@ -14,10 +15,12 @@ class GrantedBy(models.TextChoices):
 
 
 class EntitlementQuerySet(models.QuerySet):
-    def active(self):
+    def active(self, now=None):
+        # without an explicit `now`, compare against the database clock (evaluated once per query)
+        now = Now() if now is None else now
         return (
             self.filter(is_active=True)
-            .filter(models.Q(expires_at__isnull=True) | models.Q(expires_at__gt=timezone.now()))
+            .filter(models.Q(expires_at__isnull=True) | models.Q(expires_at__gt=now))
             .filter(models.Q(usage_limit__isnull=True) | models.Q(usage_count__lt=models.F("usage_limit")))
         )
 
@@ -90,6 +93,6 @@ class Entitlement(models.Model):
         updated = (
             Entitlement.objects.filter(pk=self.pk, is_active=True)
             .filter(models.Q(usage_limit__isnull=True) | models.Q(usage_count__lt=models.F("usage_limit")))
-            .update(usage_count=models.F("usage_count") + 1)
+            .update(usage_count=models.F("usage_count") + 1, updated_at=timezone.now())
         )
-        return updated > 0
+        return updated == 1
@@ -24,6 +24,14 @@ def get_active_entitlements(customer) -> list[str]:
     )
 
 
+def get_active_entitlements_for_user(user) -> list[str]:
+    return list(
+        Entitlement.objects.filter(customer__user=user).active()
+        .values_list("feature", flat=True)
+        .distinct()
+    )
+
+
 def grant(
     customer,
     feature: str,
@@ -92,12 +100,31 @@ def sync_from_subscription(subscription, features: list[str]) -> None:
 
     desired = set(features)
 
-    for feature in desired - current:
-        grant(
-            customer=subscription.customer,
-            feature=feature,
+    added = desired - current
+    if added:
+        Entitlement.objects.bulk_create(
+            [
+                Entitlement(
+                    customer=subscription.customer,
+                    feature=feature,
+                    granted_by=GrantedBy.SUBSCRIPTION,
+                    subscription=subscription,
+                )
+                for feature in added
+            ],
+            ignore_conflicts=True,
+        )
+        # rows that already existed in revoked state were skipped by the insert above
+        Entitlement.objects.filter(
+            subscription=subscription, feature__in=added, is_active=False,
+        ).update(
+            is_active=True,
+            revoked_at=None,
+            revoke_reason="",
             granted_by=GrantedBy.SUBSCRIPTION,
-            subscription=subscription,
+            expires_at=None,
+            usage_limit=None,
+            updated_at=timezone.now(),
         )
 
     removed = current - desired
@@ -107,5 +134,5 @@ def sync_from_subscription(subscription, features: list[str]) -> None:
         ).revoke_all(reason="Feature removed from subscription plan")
 
     log.info(
-        f"Synced entitlements for subscription {subscription.pk}: +{len(desired - current)} -{len(removed)} (desired={desired})"
+        f"Synced entitlements for subscription {subscription.pk}: +{len(added)} -{len(removed)} (desired={desired})"
     )
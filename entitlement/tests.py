@@ -1,8 +1,10 @@
 from datetime import timedelta
 
-from django.test import TestCase
+from django.contrib.admin.sites import AdminSite
+from django.test import RequestFactory, TestCase
 from django.utils import timezone
 
+from entitlement.admin import EntitlementAdmin
 from entitlement.models import Entitlement, GrantedBy
 from entitlement import services as entitlement_services
 from testing_utils import make_customer, make_subscription
@@ -62,6 +64,15 @@ class EntitlementQuerySetTest(TestCase):
         self.assertEqual(active.count(), 1)
         self.assertEqual(active.first().feature, "active_feat")
 
+    def test_active_accepts_explicit_now(self):
+        Entitlement.objects.create(
+            customer=self.customer,
+            feature="later",
+            expires_at=timezone.now() + timedelta(days=1),
+        )
+        self.assertEqual(Entitlement.objects.active().count(), 1)
+        self.assertEqual(Entitlement.objects.active(now=timezone.now() + timedelta(days=2)).count(), 0)
+
     def test_revoke_all_bulk(self):
         Entitlement.objects.create(customer=self.customer, feature="feat1")
         Entitlement.objects.create(customer=self.customer, feature="feat2")
@@ -93,6 +104,13 @@ class EntitlementServicesTest(TestCase):
         active = entitlement_services.get_active_entitlements(self.customer)
         self.assertEqual(sorted(active), ["api_access", "pro"])
 
+    def test_get_active_entitlements_for_user(self):
+        Entitlement.objects.create(customer=self.customer, feature="pro")
+        Entitlement.objects.create(customer=self.customer, feature="revoked", is_active=False)
+        Entitlement.objects.create(customer=make_customer(), feature="someone_else")
+        active = entitlement_services.get_active_entitlements_for_user(self.customer.user)
+        self.assertEqual(active, ["pro"])
+
     def test_grant_creates_entitlement(self):
         ent = entitlement_services.grant(self.customer, "new_feature")
         self.assertEqual(ent.feature, "new_feature")
@@ -130,6 +148,17 @@ class EntitlementServicesTest(TestCase):
         api_ent = Entitlement.objects.get(subscription=sub, feature="api_access")
         self.assertFalse(api_ent.is_active)
 
+    def test_sync_from_subscription_reactivates_revoked(self):
+        sub = make_subscription(customer=self.customer)
+        entitlement_services.sync_from_subscription(sub, ["pro", "api_access"])
+        entitlement_services.revoke_for_subscription(sub, reason="paused")
+
+        entitlement_services.sync_from_subscription(sub, ["pro", "api_access"])
+
+        ents = Entitlement.objects.filter(subscription=sub)
+        self.assertEqual(ents.count(), 2)
+        self.assertTrue(all(e.is_active and e.revoked_at is None and e.revoke_reason == "" for e in ents))
+
     def test_revoke_for_subscription(self):
         sub = make_subscription(customer=self.customer)
         entitlement_services.sync_from_subscription(sub, ["pro", "api_access"])
@@ -137,3 +166,26 @@ class EntitlementServicesTest(TestCase):
         count = entitlement_services.revoke_for_subscription(sub, reason="canceled")
         self.assertEqual(count, 2)
         self.assertEqual(Entitlement.objects.filter(subscription=sub, is_active=True).count(), 0)
+
+
+class EntitlementAdminTest(TestCase):
+
+    def test_list_validity_matches_is_valid(self):
+        customer = make_customer()
+        now = timezone.now()
+        for feature, fields in {
+            "unlimited": {},
+            "zero_limit": {"usage_limit": 0, "usage_count": 3},
+            "under_limit": {"usage_limit": 5, "usage_count": 1},
+            "at_limit": {"usage_limit": 1, "usage_count": 1},
+            "expired": {"expires_at": now - timedelta(days=1)},
+            "revoked": {"is_active": False},
+        }.items():
+            Entitlement.objects.create(customer=customer, feature=feature, **fields)
+
+        model_admin = EntitlementAdmin(Entitlement, AdminSite())
+        rows = model_admin.get_queryset(RequestFactory().get("/admin/"))
+
+        validity = {row.feature: row.is_valid_db for row in rows}
+        self.assertEqual(validity, {row.feature: row.is_valid for row in rows})
+        self.assertTrue(validity["zero_limit"])
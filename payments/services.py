@@ -1,27 +1,55 @@
 import logging
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-import stripe
 from django.conf import settings
 from django.core.cache import cache
 
 from accounts.models import Customer
-from entitlement.services import get_active_entitlements
+from billing.stripe_client import get_stripe_client
+from entitlement.services import get_active_entitlements_for_user
 from purchases.models import Purchase
-from subscriptions.models import Subscription, SubscriptionStatus
+from subscriptions.models import ACTIVE_STATUSES, Subscription
 from utility.collections import filtered_dict
 
 log = logging.getLogger("billing.payments.services")
 
 PRODUCT_CACHE_KEY = "stripe:products_and_prices"
+PRODUCT_CACHE_LOCK_KEY = f"{PRODUCT_CACHE_KEY}:lock"
+PRODUCT_CACHE_VERSION_KEY = f"{PRODUCT_CACHE_KEY}:version"
+PRODUCT_CACHE_LOCK_TIMEOUT = 30
+PRODUCT_CACHE_LOCK_WAIT = 5.0
+
+# per-process copy in front of the shared cache; invalidation only clears this process,
+# other workers pick up changes once their copy expires
+PRODUCT_LOCAL_TTL = 15
+_PRODUCT_LOCAL = {"data": None, "expires": 0.0}
+
+HISTORY_ITERATOR_THRESHOLD = 200
+
+
+def billing_status_cache_key(user_id) -> str:
+    return f"billing:status:{user_id}"
+
+
+def purchase_history_cache_key(user_id) -> str:
+    return f"purchases:hist:{user_id}"
+
+
+def _user_cache_ttl() -> int:
+    # short TTL bounds staleness from queryset.update() paths that bypass the invalidation signals
+    ttl = getattr(settings, "BILLING_STATUS_CACHE_TTL", 30)
+    return ttl + random.randint(0, max(ttl // 5, 1))
 
 
 def get_or_create_stripe_customer(user) -> Customer:
     customer, _ = Customer.objects.get_or_create(user=user)
 
     if not customer.stripe_customer_id:
-        stripe_customer = stripe.Customer.create(
-            email=user.email,
-            metadata={"user_id": str(user.id)},
+        stripe_customer = get_stripe_client().customers.create(
+            params={"email": user.email, "metadata": {"user_id": str(user.id)}},
         )
         customer.stripe_customer_id = stripe_customer.id
         customer.save(update_fields=["stripe_customer_id"])
@@ -36,7 +64,7 @@ def create_checkout(
     customer = get_or_create_stripe_customer(user)
 
     if not mode:
-        price = stripe.Price.retrieve(price_id)
+        price = get_stripe_client().prices.retrieve(price_id)
         mode = "subscription" if price.recurring else "payment"
 
     session_params = {
@@ -50,8 +78,8 @@ def create_checkout(
     if mode == "payment":
         session_params["invoice_creation"] = {"enabled": True}
 
-    session = stripe.checkout.Session.create(
-        **session_params, **filtered_dict({"idempotency_key": idempotency_key}),
+    session = get_stripe_client().checkout.sessions.create(
+        params=session_params, options=filtered_dict({"idempotency_key": idempotency_key}),
     )
     assert session.url, "No url from session"
     return session.url
@@ -60,29 +88,42 @@ def create_checkout(
 def create_portal_url(user) -> str:
     customer = get_or_create_stripe_customer(user)
 
-    session = stripe.billing_portal.Session.create(
-        customer=customer.stripe_customer_id,
-        return_url=settings.STRIPE_PORTAL_RETURN_URL,
+    session = get_stripe_client().billing_portal.sessions.create(
+        params={"customer": customer.stripe_customer_id, "return_url": settings.STRIPE_PORTAL_RETURN_URL},
     )
     return session.url
 
 
 def get_billing_status_for_user(user) -> dict:
-    customer = Customer.objects.filter(user=user).first()
+    key = billing_status_cache_key(user.id)
+    status = cache.get(key)
+    if status is None:
+        status = _load_billing_status(user)
+        cache.set(key, status, timeout=_user_cache_ttl())
+    return status
 
-    if not customer:
-        return {"has_subscription": False, "subscription": None, "entitlements": []}
 
-    subscription = Subscription.objects.filter(
-        customer=customer,
-        status__in=[
-            SubscriptionStatus.ACTIVE,
-            SubscriptionStatus.TRIALING,
-            SubscriptionStatus.PAST_DUE,
-        ],
-    ).first()
+def invalidate_billing_status(user_id) -> None:
+    cache.delete(billing_status_cache_key(user_id))
 
-    entitlements = get_active_entitlements(customer)
+
+def invalidate_purchase_history(user_id) -> None:
+    cache.delete(purchase_history_cache_key(user_id))
+
+
+def _load_billing_status(user) -> dict:
+    # both lookups go through customer__user, so neither waits on a Customer fetch; a user without
+    # a Customer simply matches nothing, which is the same empty status as before
+    subscription = (
+        Subscription.objects.filter(
+            customer__user=user,
+            status__in=ACTIVE_STATUSES,
+        )
+        .only("status", "stripe_price_id", "current_period_end", "cancel_at_period_end")
+        .first()
+    )
+
+    entitlements = get_active_entitlements_for_user(user)
 
     return {
         "has_subscription": subscription is not None,
@@ -99,43 +140,102 @@ def get_billing_status_for_user(user) -> dict:
 
 
 def get_purchase_history_for_user(user, limit: int = 50) -> list[dict]:
-    customer = Customer.objects.filter(user=user).first()
+    # joined through customer__user like billing status: no separate Customer lookup,
+    # and a user without a Customer just gets an empty list
+    purchases = (
+        Purchase.objects.filter(customer__user=user)
+        .order_by("-created_at")
+        .values("product_name", "amount", "status", "created_at")[:limit]
+    )
+    if limit > HISTORY_ITERATOR_THRESHOLD:
+        # stream large exports instead of holding the queryset's result cache next to the output list
+        purchases = purchases.iterator(chunk_size=HISTORY_ITERATOR_THRESHOLD)
 
-    if not customer:
-        return []
+    return [{**p, "amount": str(p["amount"])} for p in purchases]
 
-    purchases = Purchase.objects.filter(customer=customer).order_by("-created_at")[:limit]
 
-    return [
-        {
-            "product_name": p.product_name,
-            "amount": str(p.amount),
-            "status": p.status,
-            "created_at": p.created_at,
-        }
-        for p in purchases
-    ]
+def product_cache_key() -> str:
+    # invalidation bumps the version instead of deleting, so a Stripe fetch that raced it
+    # writes under the old key and can't resurrect stale data
+    return f"{PRODUCT_CACHE_KEY}:{cache.get(PRODUCT_CACHE_VERSION_KEY, 0)}"
+
+
+def _wait_for_product_cache(key: str) -> list[dict] | None:
+    deadline = time.monotonic() + PRODUCT_CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    return None
+
+
+def _get_local_products() -> list[dict] | None:
+    if time.monotonic() < _PRODUCT_LOCAL["expires"]:
+        return _PRODUCT_LOCAL["data"]
+    return None
+
+
+def _set_local_products(products: list[dict]) -> None:
+    _PRODUCT_LOCAL["data"] = products
+    _PRODUCT_LOCAL["expires"] = time.monotonic() + PRODUCT_LOCAL_TTL
 
 
 def get_available_products() -> list[dict]:
-    cached = cache.get(PRODUCT_CACHE_KEY)
+    local = _get_local_products()
+    if local is not None:
+        return local
+
+    key = product_cache_key()
+    cached = cache.get(key)
     if cached is not None:
+        _set_local_products(cached)
         return cached
 
-    products = stripe.Product.list(active=True)
-    prices = stripe.Price.list(active=True)
-
-    price_map: dict[str, list] = {}
-    for price in prices.data:
-        product_id = price.product if isinstance(price.product, str) else price.product.id
-        if product_id not in price_map:
-            price_map[product_id] = []
+    # single-flight: only the lock holder calls Stripe, everyone else waits for it to fill the cache.
+    # django-redis returns None (not False) when Redis is unreachable, so only an explicit False means
+    # someone else holds the lock
+    locked = cache.add(PRODUCT_CACHE_LOCK_KEY, "1", timeout=PRODUCT_CACHE_LOCK_TIMEOUT)
+    if locked is False:
+        cached = _wait_for_product_cache(key)
+        if cached is not None:
+            _set_local_products(cached)
+            return cached
+        log.warning("Timed out waiting for product cache, fetching from Stripe")
+
+    try:
+        return _fetch_and_cache_products(key)
+    finally:
+        if locked:
+            cache.delete(PRODUCT_CACHE_LOCK_KEY)
+
+
+def _list_all(service, **params) -> list:
+    # max page size, so large catalogs take as few round trips as possible
+    return list(service.list(params={"limit": 100, **params}).auto_paging_iter())
+
+
+def _fetch_and_cache_products(key: str) -> list[dict]:
+    # independent requests; stripe-python is sync-only, so overlap them on threads
+    client = get_stripe_client()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        products_future = executor.submit(_list_all, client.products, active=True)
+        prices_future = executor.submit(_list_all, client.prices, active=True)
+        products, prices = products_future.result(), prices_future.result()
+
+    price_map: dict[str, list] = defaultdict(list)
+    for price in prices:
+        # product is an id string unless expanded; exact class check is cheaper than isinstance/getattr
+        product_id = price.product
+        if product_id.__class__ is not str:
+            product_id = product_id.id
+        recurring = price.recurring
         price_map[product_id].append(
             {
                 "id": price.id,
                 "amount": price.unit_amount,
                 "currency": price.currency,
-                "interval": price.recurring.interval if price.recurring else None,
+                "interval": recurring.interval if recurring else None,
             }
         )
 
@@ -146,15 +246,49 @@ def get_available_products() -> list[dict]:
             "description": product.description,
             "prices": price_map.get(product.id, []),
         }
-        for product in products.data
+        for product in products
     ]
 
     ttl = getattr(settings, "STRIPE_PRODUCT_CACHE_TTL", 300)
-    cache.set(PRODUCT_CACHE_KEY, result, timeout=ttl)
+    # jitter so workers that filled the cache together don't all miss together
+    ttl += random.randint(0, ttl // 10)
+    cache.set(key, result, timeout=ttl)
+    _set_local_products(result)
     log.info(f"Cached {len(result)} products for {ttl}s")
 
     return result
 
 
+def get_dashboard_bundle(user) -> dict:
+    """
+    Billing status and purchase history with one cache round trip (MGET on
+    Redis); only the parts that missed go to the DB. Products are served from
+    the process copy, or else from their own versioned cache lookup.
+    """
+    status_key = billing_status_cache_key(user.id)
+    history_key = purchase_history_cache_key(user.id)
+    cached = cache.get_many([status_key, history_key])
+
+    missing = {}
+    status = cached.get(status_key)
+    if status is None:
+        status = missing[status_key] = _load_billing_status(user)
+    purchases = cached.get(history_key)
+    if purchases is None:
+        purchases = missing[history_key] = get_purchase_history_for_user(user)
+    if missing:
+        cache.set_many(missing, timeout=_user_cache_ttl())
+
+    # served from process memory most of the time; the shared cache needs its version looked up first
+    products = get_available_products()
+
+    return {"billing_status": status, "purchases": purchases, "products": products}
+
+
 def invalidate_product_cache():
-    cache.delete(PRODUCT_CACHE_KEY)
+    _PRODUCT_LOCAL["expires"] = 0.0
+    try:
+        cache.incr(PRODUCT_CACHE_VERSION_KEY)
+    except ValueError:
+        # first invalidation; if another process wins the add, the version has moved either way
+        cache.add(PRODUCT_CACHE_VERSION_KEY, 1, timeout=None)
@@ -0,0 +1,50 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from accounts.models import Customer
+from entitlement.models import Entitlement
+from payments.services import invalidate_billing_status, invalidate_purchase_history
+from purchases.models import Purchase
+from subscriptions.models import Subscription
+
+
+def _invalidate_for_customer_on_commit(instance, invalidate) -> None:
+    # use the customer if the caller already loaded it; otherwise look up just its user_id,
+    # after commit, rather than lazy-loading the whole Customer for every saved row
+    if instance._meta.get_field("customer").is_cached(instance):
+        user_id = instance.customer.user_id
+        transaction.on_commit(lambda: invalidate(user_id))
+        return
+
+    customer_id = instance.customer_id
+
+    def run():
+        user_id = Customer.objects.filter(pk=customer_id).values_list("user_id", flat=True).first()
+        if user_id is not None:
+            invalidate(user_id)
+
+    transaction.on_commit(run)
+
+
+# no post_delete for Entitlement: a listener would turn off fast deletes of the entitlements
+# cascaded from a Customer; the Customer receiver below covers that path
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+@receiver(post_save, sender=Entitlement)
+def invalidate_billing_status_on_change(sender, instance, **kwargs):
+    # after commit, so a concurrent read can't re-cache the pre-commit state
+    _invalidate_for_customer_on_commit(instance, invalidate_billing_status)
+
+
+@receiver(post_save, sender=Purchase)
+@receiver(post_delete, sender=Purchase)
+def invalidate_purchase_history_on_change(sender, instance, **kwargs):
+    _invalidate_for_customer_on_commit(instance, invalidate_purchase_history)
+
+
+@receiver(post_delete, sender=Customer)
+def invalidate_on_customer_delete(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_billing_status(user_id))
+    transaction.on_commit(lambda: invalidate_purchase_history(user_id))
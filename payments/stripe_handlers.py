@@ -0,0 +1,54 @@
+import logging
+
+from core.stripe.event_handler import WebhookHandler
+from payments.services import invalidate_product_cache
+
+log = logging.getLogger("billing.payments.stripe_handlers")
+
+
+class InvalidateProductCache(WebhookHandler):
+    """
+    Catalog changes only need the cached product list dropped; the next read
+    refetches. Subclasses just bind an event type.
+    """
+
+    __atomic__ = False
+
+    @classmethod
+    def handle(cls, data: dict):
+        invalidate_product_cache()
+        log.info(f"Product cache invalidated ({cls.__event__} {data.get('id')})")
+
+
+class HandleProductCreated(InvalidateProductCache):
+    __event__ = "product.created"
+
+
+class HandleProductUpdated(InvalidateProductCache):
+    __event__ = "product.updated"
+
+
+class HandleProductDeleted(InvalidateProductCache):
+    __event__ = "product.deleted"
+
+
+class HandlePriceCreated(InvalidateProductCache):
+    __event__ = "price.created"
+
+
+class HandlePriceUpdated(InvalidateProductCache):
+    __event__ = "price.updated"
+
+
+class HandlePriceDeleted(InvalidateProductCache):
+    __event__ = "price.deleted"
+
+
+__all__ = (
+    "HandleProductCreated",
+    "HandleProductUpdated",
+    "HandleProductDeleted",
+    "HandlePriceCreated",
+    "HandlePriceUpdated",
+    "HandlePriceDeleted",
+)
@@ -1,22 +1,34 @@
+import json
 from decimal import Decimal
 from types import SimpleNamespace
 from unittest.mock import patch, MagicMock
 
-from django.test import TestCase, RequestFactory
+from django.core.cache import cache
+from django.test import TestCase, RequestFactory, override_settings
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models.deletion import Collector
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
 
 from accounts.models import Customer
-from payments.views import get_billing_status, get_purchase_history
+from core.stripe.event_handler import dispatch_event
+from payments.views import get_billing_status, get_purchase_history, get_available_products_view
 from payments.services import (
     get_or_create_stripe_customer,
     get_billing_status_for_user,
+    billing_status_cache_key,
+    get_dashboard_bundle,
     get_purchase_history_for_user,
     get_available_products,
     invalidate_product_cache,
+    product_cache_key,
+    PRODUCT_CACHE_LOCK_KEY,
 )
 from testing_utils import make_customer, make_subscription
 from purchases.models import Purchase, PurchaseType
 from entitlement.models import Entitlement
+from subscriptions.models import Subscription
 
 
 User = get_user_model()
@@ -37,11 +49,100 @@ class GetBillingStatusServiceTest(TestCase):
         sub = make_subscription(customer=customer)
         Entitlement.objects.create(customer=customer, feature="pro")
 
-        result = get_billing_status_for_user(user)
+        with self.assertNumQueries(2):
+            result = get_billing_status_for_user(user)
         self.assertTrue(result["has_subscription"])
         self.assertEqual(result["subscription"]["status"], "active")
         self.assertIn("pro", result["entitlements"])
 
+    def test_entitlements_without_subscription(self):
+        user = User.objects.create_user(username="trialuser", email="trial@test.com", password="pass")
+        customer = make_customer(user=user, stripe_customer_id="cus_trial")
+        Entitlement.objects.create(customer=customer, feature="trial_feat")
+
+        with self.assertNumQueries(2):
+            result = get_billing_status_for_user(user)
+        self.assertFalse(result["has_subscription"])
+        self.assertEqual(result["entitlements"], ["trial_feat"])
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class BillingStatusCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="cacheuser", email="c@test.com", password="pass")
+        self.customer = make_customer(user=self.user, stripe_customer_id="cus_cache")
+        make_subscription(customer=self.customer)
+
+    def test_repeat_reads_hit_cache(self):
+        first = get_billing_status_for_user(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_billing_status_for_user(self.user), first)
+
+    def test_entitlement_save_invalidates(self):
+        get_billing_status_for_user(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            Entitlement.objects.create(customer=self.customer, feature="pro")
+
+        self.assertIsNone(cache.get(billing_status_cache_key(self.user.id)))
+        self.assertEqual(get_billing_status_for_user(self.user)["entitlements"], ["pro"])
+
+    def test_save_without_loaded_customer_defers_the_user_lookup(self):
+        subscription = Subscription.objects.get(customer=self.customer)
+        get_billing_status_for_user(self.user)
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            # just the UPDATE; the Customer isn't lazy-loaded in the receiver
+            with self.assertNumQueries(1):
+                subscription.save(update_fields=["cancel_at_period_end"])
+        with self.assertNumQueries(1):
+            for callback in callbacks:
+                callback()
+
+        self.assertIsNone(cache.get(billing_status_cache_key(self.user.id)))
+
+    def test_customer_delete_fast_deletes_entitlements_and_invalidates(self):
+        Entitlement.objects.create(customer=self.customer, feature="pro")
+        Subscription.objects.filter(customer=self.customer).delete()
+        get_billing_status_for_user(self.user)
+
+        self.assertTrue(Collector(using="default").can_fast_delete(Entitlement.objects.filter(customer=self.customer)))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.delete()
+
+        self.assertIsNone(cache.get(billing_status_cache_key(self.user.id)))
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class DashboardBundleTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        invalidate_product_cache()
+        cache.set(product_cache_key(), [])
+        self.user = User.objects.create_user(username="dashuser", email="d@test.com", password="pass")
+        self.customer = make_customer(user=self.user, stripe_customer_id="cus_dash")
+
+    def test_second_read_served_from_cache(self):
+        first = get_dashboard_bundle(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_dashboard_bundle(self.user), first)
+
+    def test_purchase_save_invalidates_history(self):
+        get_dashboard_bundle(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            Purchase.objects.create(
+                customer=self.customer,
+                purchase_type=PurchaseType.ONE_TIME,
+                amount=Decimal("5.00"),
+                product_name="Sticker",
+                stripe_price_id="price_s",
+                stripe_invoice_id="in_s",
+            )
+
+        self.assertEqual(len(get_dashboard_bundle(self.user)["purchases"]), 1)
+
 
 class GetPurchaseHistoryServiceTest(TestCase):
 
@@ -65,11 +166,47 @@ class GetPurchaseHistoryServiceTest(TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]["product_name"], "Widget")
 
+    def test_query_count_independent_of_row_count(self):
+        user = User.objects.create_user(username="testuser5", email="t5@test.com", password="pass")
+        customer = make_customer(user=user, stripe_customer_id="cus_many")
+        for i in range(10):
+            Purchase.objects.create(
+                customer=customer,
+                purchase_type=PurchaseType.ONE_TIME,
+                amount=Decimal("1.00"),
+                product_name=f"Item {i}",
+                stripe_price_id=f"price_{i}",
+                stripe_invoice_id=f"in_{i}",
+            )
+
+        with self.assertNumQueries(1):
+            result = get_purchase_history_for_user(user)
+        self.assertEqual(len(result), 10)
+
+    @patch("payments.services.HISTORY_ITERATOR_THRESHOLD", 2)
+    def test_large_limit_streams_in_order(self):
+        user = User.objects.create_user(username="testuser6", email="t6@test.com", password="pass")
+        customer = make_customer(user=user, stripe_customer_id="cus_stream")
+        for i in range(5):
+            Purchase.objects.create(
+                customer=customer,
+                purchase_type=PurchaseType.ONE_TIME,
+                amount=Decimal("1.00"),
+                product_name=f"Item {i}",
+                stripe_price_id=f"price_{i}",
+                stripe_invoice_id=f"in_{i}",
+            )
+
+        result = get_purchase_history_for_user(user, limit=4)
+        self.assertEqual([p["product_name"] for p in result], ["Item 4", "Item 3", "Item 2", "Item 1"])
+        self.assertEqual(result[0]["amount"], "1.00")
+
 
 class GetOrCreateStripeCustomerTest(TestCase):
 
-    @patch("payments.services.stripe.Customer.create")
-    def test_creates_stripe_customer_when_missing(self, mock_stripe_create):
+    @patch("payments.services.get_stripe_client")
+    def test_creates_stripe_customer_when_missing(self, mock_client):
+        mock_stripe_create = mock_client.return_value.customers.create
         mock_stripe_create.return_value = MagicMock(id="cus_new_stripe")
         user = User.objects.create_user(username="newuser", email="new@test.com", password="pass")
 
@@ -78,6 +215,20 @@ class GetOrCreateStripeCustomerTest(TestCase):
         self.assertEqual(customer.stripe_customer_id, "cus_new_stripe")
         mock_stripe_create.assert_called_once()
 
+    @patch("payments.services.get_stripe_client")
+    def test_saves_only_stripe_customer_id(self, mock_client):
+        mock_client.return_value.customers.create.return_value = MagicMock(id="cus_narrow")
+        user = User.objects.create_user(username="narrow", email="narrow@test.com", password="pass")
+        Customer.objects.create(user=user)
+
+        with CaptureQueriesContext(connection) as ctx:
+            get_or_create_stripe_customer(user)
+
+        updates = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('SET "stripe_customer_id"', updates[0])
+        self.assertNotIn(",", updates[0].split(" WHERE ")[0])
+
     def test_returns_existing_customer(self):
         user = User.objects.create_user(username="existing", email="existing@test.com", password="pass")
         Customer.objects.create(user=user, stripe_customer_id="cus_existing")
@@ -89,19 +240,23 @@ class GetOrCreateStripeCustomerTest(TestCase):
 
 class GetAvailableProductsTest(TestCase):
 
-    @patch("payments.services.stripe.Price.list")
-    @patch("payments.services.stripe.Product.list")
-    def test_caches_results(self, mock_products, mock_prices):
-        mock_products.return_value = MagicMock(data=[
+    def setUp(self):
+        invalidate_product_cache()
+
+    @patch("payments.services.get_stripe_client")
+    def test_caches_results(self, mock_client):
+        mock_products = mock_client.return_value.products.list
+        mock_prices = mock_client.return_value.prices.list
+        mock_products.return_value = MagicMock(**{"auto_paging_iter.return_value": [
             SimpleNamespace(
                 id="prod_1",
                 name="Pro",
                 description="Pro plan",
                 active=True
             ),
-        ])
+        ]})
 
-        mock_prices.return_value = MagicMock(data=[
+        mock_prices.return_value = MagicMock(**{"auto_paging_iter.return_value": [
             SimpleNamespace(
                 id="price_1",
                 product="prod_1",
@@ -110,7 +265,7 @@ class GetAvailableProductsTest(TestCase):
                 recurring=SimpleNamespace(interval="month"),
                 active=True
             ),
-        ])
+        ]})
         invalidate_product_cache()
 
         result1 = get_available_products()
@@ -126,6 +281,39 @@ class GetAvailableProductsTest(TestCase):
         self.assertEqual(mock_products.call_count, 2)
 
 
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    @patch("payments.services.get_stripe_client")
+    def test_waits_for_lock_holder_instead_of_calling_stripe(self, mock_client):
+        cache.clear()
+        invalidate_product_cache()
+        cache.add(PRODUCT_CACHE_LOCK_KEY, "1")
+        filled = [{"id": "prod_1", "name": "Pro", "description": "", "prices": []}]
+
+        with patch("payments.services.time.sleep", side_effect=lambda _: cache.set(product_cache_key(), filled)):
+            result = get_available_products()
+
+        self.assertEqual(result, filled)
+        mock_client.assert_not_called()
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_invalidation_orphans_in_flight_fill(self):
+        cache.clear()
+        stale_key = product_cache_key()
+        invalidate_product_cache()
+        # a fetch that started before the invalidation finishes after it
+        cache.set(stale_key, [{"id": "prod_stale"}])
+
+        self.assertNotEqual(product_cache_key(), stale_key)
+        self.assertIsNone(cache.get(product_cache_key()))
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_catalog_webhooks_invalidate(self):
+        cache.clear()
+        before = product_cache_key()
+        self.assertEqual(dispatch_event("price.updated", {"id": "price_1"}), 1)
+        self.assertNotEqual(product_cache_key(), before)
+
+
 class BillingStatusViewTest(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -137,3 +325,24 @@ class BillingStatusViewTest(TestCase):
         response = get_billing_status(request)
         self.assertEqual(response.status_code, 200)
         self.assertFalse(response.data["has_subscription"])
+
+
+class AvailableProductsViewTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username="prodview", email="pv@test.com", password="pass")
+
+    @patch("payments.views.get_available_products")
+    def test_reuses_encoded_body_for_same_products(self, mock_products):
+        mock_products.return_value = [{"id": "prod_1", "name": "Pro", "description": None, "prices": []}]
+
+        with patch("payments.views.JSONRenderer.render", wraps=JSONRenderer().render) as render:
+            for _ in range(2):
+                request = self.factory.get("/api/payments/products/")
+                request.user = self.user
+                response = get_available_products_view(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(json.loads(response.content), {"products": mock_products.return_value})
+        self.assertEqual(render.call_count, 1)
@@ -1,8 +1,10 @@
 import logging
 
+from django.http import HttpResponse
 from drf_spectacular.utils import extend_schema, OpenApiExample
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from payments.serializers import (
@@ -76,9 +78,19 @@ def get_purchase_history(request):
     return Response({"purchases": purchases})
 
 
+_PRODUCTS_BODY: tuple[list | None, bytes] = (None, b"")
+
+
 @extend_schema(responses={200: ProductListResponseSerializer}, tags=["Payments"])
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def get_available_products_view(request):
+    global _PRODUCTS_BODY
     products = get_available_products()
-    return Response({"products": products})
+    # the service returns the same list object while its per-process copy is fresh,
+    # so the encoded body is reused until that copy is replaced
+    cached_products, body = _PRODUCTS_BODY
+    if products is not cached_products:
+        body = JSONRenderer().render({"products": products})
+        _PRODUCTS_BODY = (products, body)
+    return HttpResponse(body, content_type="application/json")
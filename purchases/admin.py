@@ -22,4 +22,6 @@ class PurchaseAdmin(admin.ModelAdmin):
     ]
     readonly_fields = ["stripe_invoice_id", "stripe_price_id", "created_at"]
     raw_id_fields = ["customer"]
+    # Customer.__str__ reads user.email, so join both or every row costs two queries
+    list_select_related = ["customer__user"]
     ordering = ["-created_at"]
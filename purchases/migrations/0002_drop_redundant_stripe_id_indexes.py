@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-15 04:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('purchases', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='purchase',
+            name='stripe_checkout_session_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='purchase',
+            name='stripe_invoice_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import connection, models
+from django.utils import timezone
+
 from accounts.models import Customer
 
 
@@ -17,6 +19,61 @@ class PurchaseStatus(models.TextChoices):
     DISPUTED = "disputed", "Disputed"
 
 
+class PurchaseQuerySet(models.QuerySet):
+    def refund_all(self, amount=None):
+        """
+        Refund every purchase in the queryset with one UPDATE. amount=None
+        refunds each row's full amount. Returns the number of rows updated.
+        """
+        refund_amount = models.F("amount") if amount is None else amount
+        return self.update(
+            amount_refunded=models.F("amount_refunded") + refund_amount,
+            status=models.Case(
+                models.When(
+                    amount_refunded__gte=models.F("amount") - refund_amount,
+                    then=models.Value(PurchaseStatus.REFUNDED),
+                ),
+                default=models.Value(PurchaseStatus.PARTIALLY_REFUNDED),
+            ),
+            updated_at=timezone.now(),
+        )
+
+    def upsert_invoice_lines(self, purchases: list["Purchase"]) -> None:
+        """
+        Insert or update invoice-line purchases in one statement, keyed on
+        unique_purchase_per_invoice_line.
+
+        bulk_create(update_conflicts=True) can't target that constraint: it is
+        partial, and both Postgres and SQLite only match a partial index when
+        the ON CONFLICT target repeats its WHERE clause.
+        """
+        if not purchases:
+            return
+
+        opts = self.model._meta
+        fields = [f for f in opts.concrete_fields if not f.primary_key]
+        update_columns = [
+            opts.get_field(name).column
+            for name in ("customer", "purchase_type", "amount", "product_name", "updated_at")
+        ]
+        qn = connection.ops.quote_name
+
+        params = []
+        for purchase in purchases:
+            params.extend(f.get_db_prep_save(f.pre_save(purchase, add=True), connection) for f in fields)
+
+        row = f"({', '.join(['%s'] * len(fields))})"
+        sql = (
+            f"INSERT INTO {qn(opts.db_table)} ({', '.join(qn(f.column) for f in fields)}) "
+            f"VALUES {', '.join([row] * len(purchases))} "
+            f"ON CONFLICT ({qn('stripe_invoice_id')}, {qn('stripe_price_id')}) "
+            f"WHERE NOT ({qn('stripe_invoice_id')} = '') "
+            f"DO UPDATE SET {', '.join(f'{qn(c)} = EXCLUDED.{qn(c)}' for c in update_columns)}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+
 class Purchase(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name="purchases")
 
@@ -30,8 +87,9 @@ class Purchase(models.Model):
     product_name = models.CharField(max_length=255)
 
     stripe_price_id = models.CharField(max_length=255, db_index=True, blank=True, default="")
-    stripe_invoice_id = models.CharField(max_length=255, db_index=True, blank=True, default="")
-    stripe_checkout_session_id = models.CharField(max_length=255, db_index=True, blank=True, default="")
+    # invoice and checkout session lookups are served by the partial unique constraints below
+    stripe_invoice_id = models.CharField(max_length=255, blank=True, default="")
+    stripe_checkout_session_id = models.CharField(max_length=255, blank=True, default="")
     stripe_payment_intent_id = models.CharField(max_length=255, db_index=True, blank=True, default="")
     stripe_charge_id = models.CharField(max_length=255, db_index=True, blank=True, default="")
 
@@ -40,6 +98,8 @@ class Purchase(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = PurchaseQuerySet.as_manager()
+
     class Meta:
         db_table = "purchases"
         ordering = ["-created_at"]
@@ -67,25 +127,11 @@ class Purchase(models.Model):
     def net_amount(self):
         return self.amount - self.amount_refunded
 
-    def refund(self, amount=None):
-        refund_amount = self.amount if amount is None else amount
-
-        updated = (
-            Purchase.objects
-            .filter(pk=self.pk)
-            .update(
-                amount_refunded=models.F("amount_refunded") + refund_amount,
-                status=models.Case(
-                    models.When(
-                        amount_refunded__gte=models.F("amount") - refund_amount,
-                        then=models.Value(PurchaseStatus.REFUNDED),
-                    ),
-                    default=models.Value(PurchaseStatus.PARTIALLY_REFUNDED),
-                ),
-            )
-        )
+    def refund(self, amount=None, refresh: bool = False):
+        updated = Purchase.objects.filter(pk=self.pk).refund_all(amount)
 
-        if updated:
+        # the UPDATE leaves this instance stale; only pay for the re-read when the caller needs it
+        if updated and refresh:
             self.refresh_from_db(fields=["amount_refunded", "status"])
 
     def mark_disputed(self, reason: str = ""):
@@ -1,23 +1,65 @@
 import logging
 
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Q, When
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
 from accounts.models import Customer
 from core.exceptions import WebhookSkip
 from core.stripe.event_handler import WebhookHandler
 from core.stripe.models import (
-    StripeInvoice,
+    StripeInvoiceHeader,
+    StripeInvoiceLineList,
     StripeCharge,
     StripeCheckoutSession,
     StripeDispute,
     StripePaymentIntent,
 )
+from payments.services import invalidate_purchase_history
 from purchases.models import Purchase, PurchaseType
 
 log = logging.getLogger("billing.purchases.stripe_handlers")
 
+_INVOICE_BILLING_REASON_TO_PURCHASE_TYPE = {
+    "subscription_create": PurchaseType.SUBSCRIPTION_NEW,
+    "subscription_cycle": PurchaseType.SUBSCRIPTION_RENEWAL,
+    "subscription_update": PurchaseType.SUBSCRIPTION_UPGRADE,
+}
+
+
+CUSTOMER_IDS_CACHE_TTL = 60
+
+
+def customer_ids_cache_key(stripe_customer_id: str) -> str:
+    return f"customer:ids:{stripe_customer_id}"
+
 
-def _get_customer_or_skip(stripe_customer_id: str, context: str) -> Customer:
+def _customer_ids(stripe_customer_id: str) -> tuple[int, int]:
+    """
+    (customer pk, user id) for a Stripe customer id, kept briefly in the shared cache so
+    bursts of webhooks for one customer skip the SELECT. Deleting a Customer drops its
+    entry for every worker; a Customer moved to a new Stripe id can still resolve under
+    the old one for up to CUSTOMER_IDS_CACHE_TTL. Misses raise DoesNotExist and aren't cached.
+    """
+    key = customer_ids_cache_key(stripe_customer_id)
+    ids = cache.get(key)
+    if ids is None:
+        ids = tuple(Customer.objects.values_list("pk", "user_id").get(stripe_customer_id=stripe_customer_id))
+        cache.set(key, ids, timeout=CUSTOMER_IDS_CACHE_TTL)
+    return ids
+
+
+@receiver(post_delete, sender=Customer)
+def _forget_customer_ids(sender, instance, **kwargs):
+    if instance.stripe_customer_id:
+        transaction.on_commit(lambda: cache.delete(customer_ids_cache_key(instance.stripe_customer_id)))
+
+
+def _get_customer_ids_or_skip(stripe_customer_id: str, context: str) -> tuple[int, int]:
     try:
-        return Customer.objects.get(stripe_customer_id=stripe_customer_id)
+        return _customer_ids(stripe_customer_id)
     except Customer.DoesNotExist:
         raise WebhookSkip(
             f"No customer for stripe_customer_id={stripe_customer_id} ({context})",
@@ -25,9 +67,9 @@ def _get_customer_or_skip(stripe_customer_id: str, context: str) -> Customer:
         )
 
 
-def _get_customer_or_none(stripe_customer_id: str, context: str) -> Customer | None:
+def _get_customer_ids_or_none(stripe_customer_id: str, context: str) -> tuple[int, int] | None:
     try:
-        return Customer.objects.get(stripe_customer_id=stripe_customer_id)
+        return _customer_ids(stripe_customer_id)
     except Customer.DoesNotExist:
         log.warning(f"No customer for stripe_customer_id={stripe_customer_id} ({context})")
         return None
@@ -38,30 +80,32 @@ class HandleInvoicePaid(WebhookHandler):
 
     @classmethod
     def handle(cls, data: dict):
-        event = StripeInvoice.model_validate(data)
+        # lines are only parsed once we know there is a customer to record them against
+        event = StripeInvoiceHeader.model_validate(data)
 
-        customer = _get_customer_or_none(event.customer, f"invoice.paid {event.id}")
-        if not customer:
+        customer_ids = _get_customer_ids_or_none(event.customer, f"invoice.paid {event.id}")
+        if not customer_ids:
             return
-
-        purchase_type_map = {
-            "subscription_create": PurchaseType.SUBSCRIPTION_NEW,
-            "subscription_cycle": PurchaseType.SUBSCRIPTION_RENEWAL,
-            "subscription_update": PurchaseType.SUBSCRIPTION_UPGRADE,
-        }
-        purchase_type = purchase_type_map.get(event.billing_reason or "", PurchaseType.ONE_TIME)
-
-        for line in event.lines.data:
-            Purchase.objects.update_or_create(
+        customer_id, user_id = customer_ids
+
+        purchase_type = _INVOICE_BILLING_REASON_TO_PURCHASE_TYPE.get(event.billing_reason or "", PurchaseType.ONE_TIME)
+
+        # keyed by price like the unique constraint: a single upsert can't touch the same row twice,
+        # and the last line for a price wins, as it did with per-line update_or_create
+        lines = {
+            line.price_id: Purchase(
+                customer_id=customer_id,
+                purchase_type=purchase_type,
+                amount=line.amount_dollars,
+                product_name=line.description,
                 stripe_invoice_id=event.id,
                 stripe_price_id=line.price_id,
-                defaults={
-                    "customer": customer,
-                    "purchase_type": purchase_type,
-                    "amount": line.amount_dollars,
-                    "product_name": line.description,
-                },
             )
+            for line in StripeInvoiceLineList.validate_python(data.get("lines", {}).get("data", []))
+        }
+        Purchase.objects.upsert_invoice_lines(list(lines.values()))
+        # raw upsert skips post_save, so drop the cached history ourselves
+        transaction.on_commit(lambda: invalidate_purchase_history(user_id))
 
 
 class HandleCheckoutSessionCompleted(WebhookHandler):
@@ -85,22 +129,27 @@ class HandleCheckoutSessionCompleted(WebhookHandler):
                 context={"session_id": event.id},
             )
 
-        customer = _get_customer_or_skip(event.customer, f"checkout.session.completed {event.id}")
-
-        if Purchase.objects.filter(stripe_checkout_session_id=event.id).exists():
-            log.info(f"Purchase already exists for checkout session {event.id}, skipping")
-            return
-
-        Purchase.objects.create(
-            customer=customer,
-            purchase_type=PurchaseType.ONE_TIME,
-            amount=event.amount_total_dollars or 0,
-            product_name=event.metadata.get("product_name", "One-time purchase"),
-            stripe_checkout_session_id=event.id,
-            stripe_payment_intent_id=event.payment_intent or "",
+        customer_id, user_id = _get_customer_ids_or_skip(event.customer, f"checkout.session.completed {event.id}")
+
+        # unique_purchase_per_checkout_session makes redeliveries a no-op (ON CONFLICT DO NOTHING),
+        # without a racy exists() check in front
+        Purchase.objects.bulk_create(
+            [
+                Purchase(
+                    customer_id=customer_id,
+                    purchase_type=PurchaseType.ONE_TIME,
+                    amount=event.amount_total_dollars or 0,
+                    product_name=event.metadata.get("product_name", "One-time purchase"),
+                    stripe_checkout_session_id=event.id,
+                    stripe_payment_intent_id=event.payment_intent or "",
+                )
+            ],
+            ignore_conflicts=True,
         )
+        # bulk_create skips post_save, so drop the cached history ourselves
+        transaction.on_commit(lambda: invalidate_purchase_history(user_id))
 
-        log.info(f"Created one-time purchase from checkout {event.id} for customer {customer.pk}")
+        log.info(f"Recorded one-time purchase from checkout {event.id} for customer {customer_id}")
 
 
 class HandleChargeRefunded(WebhookHandler):
@@ -115,15 +164,20 @@ class HandleChargeRefunded(WebhookHandler):
             return
 
         purchases = Purchase.objects.filter(stripe_invoice_id=event.invoice)
+        user_ids = set(purchases.values_list("customer__user_id", flat=True).distinct())
+
+        # one UPDATE across every line of the invoice; zero rows means we never recorded it
+        refunded = purchases.refund_all(event.amount_refunded_dollars)
 
-        if not purchases.exists():
+        if not refunded:
             raise WebhookSkip(
                 f"No purchase for invoice {event.invoice} on refund",
                 context={"invoice_id": event.invoice},
             )
 
-        for purchase in purchases:
-            purchase.refund(event.amount_refunded_dollars)
+        # update() skips post_save, so drop the cached history ourselves
+        for user_id in user_ids:
+            transaction.on_commit(lambda user_id=user_id: invalidate_purchase_history(user_id))
 
 
 class HandleChargeDisputeCreated(WebhookHandler):
@@ -134,12 +188,22 @@ class HandleChargeDisputeCreated(WebhookHandler):
         event = StripeDispute.model_validate(data)
 
         purchase = None
-
+        match = Q()
         if event.charge:
-            purchase = Purchase.objects.filter(stripe_charge_id=event.charge).first()
-
-        if not purchase and event.payment_intent:
-            purchase = Purchase.objects.filter(stripe_payment_intent_id=event.payment_intent).first()
+            match |= Q(stripe_charge_id=event.charge)
+        if event.payment_intent:
+            match |= Q(stripe_payment_intent_id=event.payment_intent)
+
+        if match:
+            # one query for both lookups; a charge match still wins over a payment intent match
+            purchase = (
+                Purchase.objects.filter(match)
+                .order_by(Case(When(stripe_charge_id=event.charge, then=0), default=1), "-created_at")
+                # customer__user feeds the history-cache invalidation on save without another query
+                .select_related("customer")
+                .only("id", "status", "customer__user")
+                .first()
+            )
 
         if not purchase:
             raise WebhookSkip(
@@ -1,15 +1,21 @@
 from decimal import Decimal
 
-from django.test import TestCase
+from django.contrib.admin.sites import site as admin_site
+from django.db import IntegrityError, transaction
+from django.test import RequestFactory, TestCase
 
 from purchases.models import Purchase, PurchaseType, PurchaseStatus
-from testing_utils import make_customer
+from testing_utils import make_customer, make_user
 
 
 class PurchaseRefundTest(TestCase):
 
-    def setUp(self):
-        self.customer = make_customer()
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = make_customer()
+
+    def _row(self, purchase):
+        return Purchase.objects.filter(pk=purchase.pk).values("status", "amount", "amount_refunded", "dispute_reason").get()
 
     def test_full_refund(self):
         p = Purchase.objects.create(
@@ -21,10 +27,10 @@ class PurchaseRefundTest(TestCase):
             stripe_invoice_id="in_test",
         )
         p.refund()
-        p.refresh_from_db()
-        self.assertEqual(p.status, PurchaseStatus.REFUNDED)
-        self.assertEqual(p.amount_refunded, Decimal("29.99"))
-        self.assertEqual(p.net_amount, Decimal("0.00"))
+        row = self._row(p)
+        self.assertEqual(row["status"], PurchaseStatus.REFUNDED)
+        self.assertEqual(row["amount_refunded"], Decimal("29.99"))
+        self.assertEqual(row["amount"] - row["amount_refunded"], Decimal("0.00"))
 
     def test_partial_refund(self):
         p = Purchase.objects.create(
@@ -36,10 +42,45 @@ class PurchaseRefundTest(TestCase):
             stripe_invoice_id="in_test",
         )
         p.refund(Decimal("10.00"))
-        p.refresh_from_db()
-        self.assertEqual(p.status, PurchaseStatus.PARTIALLY_REFUNDED)
+        row = self._row(p)
+        self.assertEqual(row["status"], PurchaseStatus.PARTIALLY_REFUNDED)
+        self.assertEqual(row["amount_refunded"], Decimal("10.00"))
+        self.assertEqual(row["amount"] - row["amount_refunded"], Decimal("19.99"))
+
+    def test_refund_refresh_is_opt_in(self):
+        p = Purchase.objects.create(
+            customer=self.customer,
+            purchase_type=PurchaseType.ONE_TIME,
+            amount=Decimal("29.99"),
+            product_name="Pro Plan",
+            stripe_price_id="price_pro",
+            stripe_invoice_id="in_test",
+        )
+        with self.assertNumQueries(1):
+            p.refund(Decimal("5.00"))
+        self.assertEqual(p.amount_refunded, Decimal("0"))
+
+        with self.assertNumQueries(2):
+            p.refund(Decimal("5.00"), refresh=True)
         self.assertEqual(p.amount_refunded, Decimal("10.00"))
-        self.assertEqual(p.net_amount, Decimal("19.99"))
+
+    def test_refund_all_updates_every_line_in_one_query(self):
+        for price_id, amount in [("price_a", Decimal("10.00")), ("price_b", Decimal("5.00"))]:
+            Purchase.objects.create(
+                customer=self.customer,
+                purchase_type=PurchaseType.ONE_TIME,
+                amount=amount,
+                product_name=price_id,
+                stripe_price_id=price_id,
+                stripe_invoice_id="in_multi",
+            )
+
+        with self.assertNumQueries(1):
+            count = Purchase.objects.filter(stripe_invoice_id="in_multi").refund_all(Decimal("5.00"))
+
+        self.assertEqual(count, 2)
+        statuses = dict(Purchase.objects.values_list("stripe_price_id", "status"))
+        self.assertEqual(statuses, {"price_a": PurchaseStatus.PARTIALLY_REFUNDED, "price_b": PurchaseStatus.REFUNDED})
 
     def test_mark_disputed(self):
         p = Purchase.objects.create(
@@ -50,6 +91,75 @@ class PurchaseRefundTest(TestCase):
             stripe_charge_id="ch_disp",
         )
         p.mark_disputed(reason="fraudulent")
-        p.refresh_from_db()
-        self.assertEqual(p.status, PurchaseStatus.DISPUTED)
-        self.assertEqual(p.dispute_reason, "fraudulent")
+        row = self._row(p)
+        self.assertEqual(row["status"], PurchaseStatus.DISPUTED)
+        self.assertEqual(row["dispute_reason"], "fraudulent")
+
+
+class PurchaseUpsertTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = make_customer()
+
+    def _line(self, price_id, amount):
+        return Purchase(
+            customer=self.customer,
+            purchase_type=PurchaseType.SUBSCRIPTION_NEW,
+            amount=amount,
+            product_name=price_id,
+            stripe_invoice_id="in_upsert",
+            stripe_price_id=price_id,
+        )
+
+    def test_inserts_then_updates_in_place(self):
+        with self.assertNumQueries(1):
+            Purchase.objects.upsert_invoice_lines([self._line("price_a", Decimal("10.00")), self._line("price_b", Decimal("5.00"))])
+        original = Purchase.objects.get(stripe_price_id="price_a")
+
+        Purchase.objects.upsert_invoice_lines([self._line("price_a", Decimal("12.00"))])
+
+        self.assertEqual(Purchase.objects.filter(stripe_invoice_id="in_upsert").count(), 2)
+        updated = Purchase.objects.get(stripe_price_id="price_a")
+        self.assertEqual(updated.pk, original.pk)
+        self.assertEqual(updated.amount, Decimal("12.00"))
+        self.assertEqual(updated.created_at, original.created_at)
+
+    def test_invoice_line_is_unique_only_when_invoice_id_set(self):
+        self._line("price_a", Decimal("10.00")).save()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self._line("price_a", Decimal("10.00")).save()
+
+        # checkout purchases have no invoice id and may share a price
+        for _ in range(2):
+            Purchase.objects.create(
+                customer=self.customer,
+                purchase_type=PurchaseType.ONE_TIME,
+                amount=Decimal("1.00"),
+                product_name="one-off",
+                stripe_price_id="price_a",
+            )
+
+
+class PurchaseAdminTest(TestCase):
+
+    def test_changelist_rows_do_not_query_per_row(self):
+        for i in range(10):
+            Purchase.objects.create(
+                customer=make_customer(),
+                purchase_type=PurchaseType.ONE_TIME,
+                amount=Decimal("1.00"),
+                product_name=f"Item {i}",
+                stripe_price_id=f"price_{i}",
+                stripe_invoice_id=f"in_{i}",
+            )
+        admin_user = make_user()
+        admin_user.is_staff = admin_user.is_superuser = True
+        admin_user.save()
+        request = RequestFactory().get("/admin/purchases/purchase/")
+        request.user = admin_user
+
+        changelist = admin_site.get_model_admin(Purchase).get_changelist_instance(request)
+        with self.assertNumQueries(1):
+            rendered = [str(p) for p in changelist.result_list]
+        self.assertEqual(len(rendered), 10)
@@ -0,0 +1,17 @@
+from django_filters import rest_framework as filters
+
+from subscriptions.models import Subscription, SubscriptionStatus
+
+
+class CharInFilter(filters.BaseInFilter, filters.CharFilter):
+    pass
+
+
+class SubscriptionFilter(filters.FilterSet):
+    # declared once here; filterset_fields makes DjangoFilterBackend build a new class per request
+    status = filters.ChoiceFilter(choices=SubscriptionStatus.choices)
+    status__in = CharInFilter(field_name="status", lookup_expr="in", help_text="Multiple values may be separated by commas.")
+
+    class Meta:
+        model = Subscription
+        fields = ["status"]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-15 05:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
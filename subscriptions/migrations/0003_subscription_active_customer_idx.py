@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-15 05:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('subscriptions', '0002_subscription_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(condition=models.Q(('status__in', ('active', 'trialing', 'past_due'))), fields=['customer'], name='sub_active_customer_idx'),
+        ),
+    ]
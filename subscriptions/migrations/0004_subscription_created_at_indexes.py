@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-15 05:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('subscriptions', '0003_subscription_active_customer_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='subscription',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['customer', 'created_at'], name='subscriptio_custome_42e430_idx'),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from hmac import new
 import logging
-from django.db import models
+from django.db import connections, models
+from django.db.models.query import RawQuerySet
 from django.utils import timezone
 
 log = logging.getLogger("billing.subscriptions")
@@ -17,18 +18,81 @@ class SubscriptionStatus(models.TextChoices):
     PAUSED = "paused", "Paused"
 
 
-EXPECTED_TRANSITIONS: dict[str, set[str]] = {
-    SubscriptionStatus.ACTIVE: {SubscriptionStatus.PAST_DUE, SubscriptionStatus.CANCELED, SubscriptionStatus.PAUSED, SubscriptionStatus.UNPAID},
-    SubscriptionStatus.TRIALING: {SubscriptionStatus.ACTIVE, SubscriptionStatus.PAST_DUE, SubscriptionStatus.CANCELED, SubscriptionStatus.PAUSED},
-    SubscriptionStatus.PAST_DUE: {SubscriptionStatus.ACTIVE, SubscriptionStatus.CANCELED, SubscriptionStatus.UNPAID},
-    SubscriptionStatus.PAUSED: {SubscriptionStatus.ACTIVE, SubscriptionStatus.CANCELED},
-    SubscriptionStatus.INCOMPLETE: {SubscriptionStatus.ACTIVE, SubscriptionStatus.TRIALING, SubscriptionStatus.INCOMPLETE_EXPIRED, SubscriptionStatus.CANCELED},
-    SubscriptionStatus.INCOMPLETE_EXPIRED: set(),
-    SubscriptionStatus.UNPAID: {SubscriptionStatus.CANCELED},
-    SubscriptionStatus.CANCELED: set(),
+# statuses that still grant access; the partial index below covers exactly these
+ACTIVE_STATUSES = (
+    SubscriptionStatus.ACTIVE,
+    SubscriptionStatus.TRIALING,
+    SubscriptionStatus.PAST_DUE,
+)
+
+
+EXPECTED_TRANSITIONS: dict[str, frozenset[str]] = {
+    SubscriptionStatus.ACTIVE: frozenset({SubscriptionStatus.PAST_DUE, SubscriptionStatus.CANCELED, SubscriptionStatus.PAUSED, SubscriptionStatus.UNPAID}),
+    SubscriptionStatus.TRIALING: frozenset({SubscriptionStatus.ACTIVE, SubscriptionStatus.PAST_DUE, SubscriptionStatus.CANCELED, SubscriptionStatus.PAUSED}),
+    SubscriptionStatus.PAST_DUE: frozenset({SubscriptionStatus.ACTIVE, SubscriptionStatus.CANCELED, SubscriptionStatus.UNPAID}),
+    SubscriptionStatus.PAUSED: frozenset({SubscriptionStatus.ACTIVE, SubscriptionStatus.CANCELED}),
+    SubscriptionStatus.INCOMPLETE: frozenset({SubscriptionStatus.ACTIVE, SubscriptionStatus.TRIALING, SubscriptionStatus.INCOMPLETE_EXPIRED, SubscriptionStatus.CANCELED}),
+    SubscriptionStatus.INCOMPLETE_EXPIRED: frozenset(),
+    SubscriptionStatus.UNPAID: frozenset({SubscriptionStatus.CANCELED}),
+    SubscriptionStatus.CANCELED: frozenset(),
 }
 
 
+class SubscriptionQuerySet(models.QuerySet):
+    def with_owner(self):
+        """Join the customer and its user, for anything that reads email or the user."""
+        return self.select_related("customer__user")
+
+    def transition(self, stripe_subscription_id: str, new_status: str, **fields) -> "Subscription | None":
+        """
+        Move a subscription to new_status (setting any extra fields and
+        bumping version) in one UPDATE ... RETURNING, guarded to the statuses
+        EXPECTED_TRANSITIONS allows it from. Returns the updated row, loaded
+        with only its keys and the written fields, with its customer attached
+        (only pk and user_id loaded), or None when nothing matched: an unknown
+        id, or a current status the transition isn't expected from.
+        """
+        sources = [status for status, targets in EXPECTED_TRANSITIONS.items() if new_status in targets]
+        if not sources:
+            return None
+
+        opts = self.model._meta
+        customer_field = opts.get_field("customer")
+        customer_opts = customer_field.related_model._meta
+        # as QuerySet.update() does, so self.db routes to the write database
+        self._for_write = True
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        column = {name: qn(opts.get_field(name).column) for name in ("version", "status", "stripe_subscription_id")}
+
+        values = {"status": new_status, **fields, "updated_at": timezone.now()}
+        # callers only read what they just wrote plus the keys; raw() defers the rest
+        returned = dict.fromkeys(["id", "customer", "stripe_subscription_id", "version", *values])
+        params = [opts.get_field(name).get_db_prep_save(value, connection) for name, value in values.items()]
+        params += [stripe_subscription_id, *sources]
+
+        sql = (
+            f"UPDATE {qn(opts.db_table)} "
+            f"SET {', '.join(f'{qn(opts.get_field(name).column)} = %s' for name in values)}, "
+            f"{column['version']} = {column['version']} + 1 "
+            f"WHERE {column['stripe_subscription_id']} = %s AND {column['status']} IN ({', '.join(['%s'] * len(sources))}) "
+            f"RETURNING {', '.join(qn(opts.get_field(name).column) for name in returned)}, "
+            f"(SELECT {qn(customer_opts.get_field('user').column)} FROM {qn(customer_opts.db_table)} "
+            f"WHERE {qn(customer_opts.pk.column)} = {qn(opts.db_table)}.{qn(customer_field.column)}) AS customer_user_id"
+        )
+        # a RawQuerySet rather than a bare cursor so column values go through the fields' db
+        # converters; pinned to self.db, since Manager.raw() would route this write as a read
+        subscription = next(iter(RawQuerySet(sql, model=self.model, params=params, using=self.db)), None)
+        if subscription is None:
+            return None
+
+        subscription.customer = customer_field.related_model.from_db(
+            self.db, ["id", "user_id"], [subscription.customer_id, subscription.customer_user_id]
+        )
+        del subscription.customer_user_id
+        return subscription
+
+
 class Subscription(models.Model):
     customer = models.ForeignKey("accounts.Customer", on_delete=models.PROTECT, related_name="subscriptions")
 
@@ -54,13 +118,25 @@ class Subscription(models.Model):
     paused_at = models.DateTimeField(null=True, blank=True)
     resumed_at = models.DateTimeField(null=True, blank=True)
 
-    created_at = models.DateTimeField(auto_now_add=True)
+    # every write bumps this in SQL (F() or version + 1) or under a row lock, never from a
+    # stale loaded value; lets the transition fallback update without holding a row lock
+    version = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = SubscriptionQuerySet.as_manager()
+
     class Meta:
         db_table = "subscriptions"
         indexes = [
             models.Index(fields=["customer", "status"]),
+            models.Index(fields=["customer", "created_at"]),
+            models.Index(
+                fields=["customer"],
+                condition=models.Q(status__in=ACTIVE_STATUSES),
+                name="sub_active_customer_idx",
+            ),
         ]
 
     def __str__(self):
@@ -68,24 +144,30 @@ class Subscription(models.Model):
 
     @property
     def is_active(self) -> bool:
-        return self.status in (
-            SubscriptionStatus.ACTIVE,
-            SubscriptionStatus.TRIALING,
-            SubscriptionStatus.PAST_DUE,
-        )
+        return self.status in ACTIVE_STATUSES
 
     def cancel(self):
-        self.apply_new_status(SubscriptionStatus.CANCELED)
-        self.canceled_at = timezone.now()
-        self.save(update_fields=["status", "canceled_at", "updated_at"])
+        self.transition_to(SubscriptionStatus.CANCELED, canceled_at=timezone.now())
 
     def pause(self):
-        self.apply_new_status(SubscriptionStatus.PAUSED)
-        self.paused_at = timezone.now()
-        self.save(update_fields=["status", "paused_at", "updated_at"])
+        self.transition_to(SubscriptionStatus.PAUSED, paused_at=timezone.now())
+
+    def transition_to(self, new_status: str, **fields):
+        """
+        apply_new_status, set any extra fields, and write them all in a single
+        UPDATE. version is bumped in SQL, not from the loaded value, so a write
+        that landed since this instance was read still moves version on for
+        the guarded writers; the new value is then re-read.
+        """
+        self.apply_new_status(new_status)
+        for field, value in fields.items():
+            setattr(self, field, value)
+        self.version = models.F("version") + 1
+        self.save(update_fields=["status", *fields, "version", "updated_at"])
+        self.refresh_from_db(fields=["version"])
 
     def apply_new_status(self, new_status: str):
-        if new_status not in EXPECTED_TRANSITIONS.get(self.status, set()):
+        if new_status not in EXPECTED_TRANSITIONS.get(self.status, frozenset()):
             log.warning(f"Unexpected transition {self.status} → {new_status} for {self.stripe_subscription_id}")
         self.status = new_status
 
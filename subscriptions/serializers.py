@@ -7,6 +7,32 @@ class SubscriptionSerializer(serializers.ModelSerializer):
     status_display = serializers.CharField(source="get_status_display", read_only=True)
     customer_email = serializers.EmailField(source="customer.email", read_only=True)
 
+    # the columns the fields below read; keep in step with Meta.fields
+    LOADED_COLUMNS = (
+        "id",
+        "stripe_subscription_id",
+        "stripe_price_id",
+        "status",
+        "current_period_start",
+        "current_period_end",
+        "cancel_at_period_end",
+        "trial_start",
+        "trial_end",
+        "created_at",
+        "customer__billing_email",
+    )
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, *, with_user: bool = True):
+        """
+        Join and load only what serialization reads. customer.email falls back
+        to user.email, so the user is joined too unless the caller attaches it
+        to each row itself (with_user=False).
+        """
+        if not with_user:
+            return queryset.select_related("customer").only(*cls.LOADED_COLUMNS)
+        return queryset.with_owner().only(*cls.LOADED_COLUMNS, "customer__user__email")
+
     class Meta:
         model = Subscription
         fields = [
@@ -1,14 +1,17 @@
 import logging
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
-import stripe
 
 from accounts.models import Customer
 from core.exceptions import WebhookSkip, WebhookRetry
+from core.stripe.tasks import refresh_subscription_from_stripe
 from core.stripe.event_handler import WebhookHandler
 from core.stripe.models import StripeSubscription
 from entitlement.services import sync_from_subscription, revoke_for_subscription
+from payments.services import invalidate_billing_status
 from subscriptions.models import Subscription, SubscriptionStatus
 
 log = logging.getLogger("billing.subscriptions.stripe_handlers")
@@ -18,17 +21,88 @@ def _get_features_for_price(price_id: str) -> list[str]:
     return settings.STRIPE_PRICE_TO_FEATURES.get(price_id, [])
 
 
-def ensure_valid_subscription_model(data: dict) -> StripeSubscription:
+def ensure_valid_subscription_model(data: dict, event_type: str) -> StripeSubscription:
     event = StripeSubscription.model_validate(data)
-    if event.current_period_start is None:
-        log.info(f"Subscription {event.id} missing period fields, fetching from Stripe")
-        full_sub = stripe.Subscription.retrieve(event.id)
-        event = StripeSubscription.model_validate(full_sub)
+    if event.current_period_start is not None:
+        return event
+
+    stored = (
+        Subscription.objects.filter(stripe_subscription_id=event.id)
+        .values_list("current_period_start", "current_period_end")
+        .first()
+    )
+    if stored is not None:
+        log.info(f"Subscription {event.id} missing period fields, using stored ones")
+        start, end = stored
+        return event.model_copy(
+            update={"current_period_start": int(start.timestamp()), "current_period_end": int(end.timestamp())}
+        )
+
+    # nothing stored either; fetch from Stripe off the webhook worker and re-run the event there
+    refresh_subscription_from_stripe.delay(event.id, event_type)
+    raise WebhookSkip(
+        f"Subscription {event.id} missing period fields, deferred to a Stripe refresh",
+        context={"stripe_subscription_id": event.id},
+    )
+
+
+def _locked_subscriptions():
+    # customer is read by entitlement sync and the billing-status invalidation on save;
+    # of=("self",) keeps the row lock off the joined customer
+    return Subscription.objects.select_for_update(of=("self",)).select_related("customer")
+
 
-    if event.current_period_start is None:
-        raise WebhookSkip(f"Subscription {event.id} has no period data even after fetch")
+TRANSITION_ATTEMPTS = 3
 
-    return event
+
+def _transition(stripe_subscription_id: str, new_status: str, action: str, **fields) -> Subscription:
+    subscription = Subscription.objects.transition(stripe_subscription_id, new_status, **fields)
+    if subscription is None:
+        subscription = _apply_unexpected_transition(stripe_subscription_id, new_status, action, **fields)
+
+    # update() fires no post_save, so invalidate the way the signal would have
+    user_id = subscription.customer.user_id
+    transaction.on_commit(lambda: invalidate_billing_status(user_id))
+    return subscription
+
+
+def _apply_unexpected_transition(stripe_subscription_id: str, new_status: str, action: str, **fields) -> Subscription:
+    # unknown id, or a transition EXPECTED_TRANSITIONS doesn't list; Stripe is the source of
+    # truth, so apply it anyway (apply_new_status warns), guarded on version instead of a row lock
+    for _ in range(TRANSITION_ATTEMPTS):
+        try:
+            subscription = (
+                Subscription.objects.select_related("customer")
+                .only("id", "stripe_subscription_id", "status", "version", "customer__user")
+                .get(stripe_subscription_id=stripe_subscription_id)
+            )
+        except Subscription.DoesNotExist:
+            raise WebhookSkip(
+                f"Subscription {stripe_subscription_id} not found for {action}",
+                context={"stripe_subscription_id": stripe_subscription_id},
+            )
+
+        seen_version = subscription.version
+        subscription.apply_new_status(new_status)
+        subscription.updated_at = timezone.now()
+        subscription.version = seen_version + 1
+        for field, value in fields.items():
+            setattr(subscription, field, value)
+
+        updated = Subscription.objects.filter(pk=subscription.pk, version=seen_version).update(
+            status=subscription.status,
+            updated_at=subscription.updated_at,
+            version=subscription.version,
+            **fields,
+        )
+        if updated:
+            return subscription
+        log.info(f"Subscription {stripe_subscription_id} changed during {action}, retrying")
+
+    raise WebhookRetry(
+        f"Subscription {stripe_subscription_id} kept changing during {action}",
+        context={"stripe_subscription_id": stripe_subscription_id},
+    )
 
 
 class HandleSubscriptionCreated(WebhookHandler):
@@ -36,7 +110,7 @@ class HandleSubscriptionCreated(WebhookHandler):
 
     @classmethod
     def handle(cls, data: dict):
-        event = ensure_valid_subscription_model(data)
+        event = ensure_valid_subscription_model(data, cls.__event__)
 
         try:
             customer = Customer.objects.get(stripe_customer_id=event.customer)
@@ -46,19 +120,24 @@ class HandleSubscriptionCreated(WebhookHandler):
                 context={"stripe_customer_id": event.customer},
             )
 
+        fields = {
+            "customer": customer,
+            "stripe_price_id": event.price_id,
+            "status": event.status,
+            "current_period_start": event.current_period_start_dt,
+            "current_period_end": event.current_period_end_dt,
+            "cancel_at_period_end": event.cancel_at_period_end,
+            "trial_start": event.trial_start_dt,
+            "trial_end": event.trial_end_dt,
+        }
+        # a redelivery rewrites status, so it must bump version like every other writer
         subscription, created = Subscription.objects.update_or_create(
             stripe_subscription_id=event.id,
-            defaults={
-                "customer": customer,
-                "stripe_price_id": event.price_id,
-                "status": event.status,
-                "current_period_start": event.current_period_start_dt,
-                "current_period_end": event.current_period_end_dt,
-                "cancel_at_period_end": event.cancel_at_period_end,
-                "trial_start": event.trial_start_dt,
-                "trial_end": event.trial_end_dt,
-            },
+            defaults={**fields, "version": F("version") + 1},
+            create_defaults=fields,
         )
+        if not created:
+            subscription.refresh_from_db(fields=["version"])
 
         action = "Created" if created else "Updated (idempotent)"
         log.info(f"{action} subscription {subscription.pk} for customer {customer.pk}")
@@ -73,28 +152,40 @@ class HandleSubscriptionUpdated(WebhookHandler):
 
     @classmethod
     def handle(cls, data: dict):
-        event = ensure_valid_subscription_model(data)
+        event = ensure_valid_subscription_model(data, cls.__event__)
 
         try:
-            subscription = Subscription.objects.select_for_update().get(stripe_subscription_id=event.id)
+            subscription = _locked_subscriptions().get(stripe_subscription_id=event.id)
         except Subscription.DoesNotExist:
             raise WebhookSkip(
                 f"Subscription {event.id} not found for update",
                 context={"stripe_subscription_id": event.id},
             )
 
-        subscription.stripe_price_id = event.price_id
-        subscription.current_period_start = event.current_period_start_dt
-        subscription.current_period_end = event.current_period_end_dt
-        subscription.cancel_at_period_end = event.cancel_at_period_end
-        subscription.canceled_at = event.canceled_at_dt
-        subscription.trial_start = event.trial_start_dt
-        subscription.trial_end = event.trial_end_dt
+        incoming = {
+            "stripe_price_id": event.price_id,
+            "current_period_start": event.current_period_start_dt,
+            "current_period_end": event.current_period_end_dt,
+            "cancel_at_period_end": event.cancel_at_period_end,
+            "canceled_at": event.canceled_at_dt,
+            "trial_start": event.trial_start_dt,
+            "trial_end": event.trial_end_dt,
+        }
+        changed = [field for field, value in incoming.items() if getattr(subscription, field) != value]
+        for field in changed:
+            setattr(subscription, field, incoming[field])
 
         if event.status != subscription.status:
             subscription.apply_new_status(event.status)
+            changed.append("status")
 
-        subscription.save()
+        # Stripe sends updated events for changes we don't store (metadata, items, ...);
+        # only write the columns that moved, and skip the UPDATE entirely when none did
+        if changed:
+            subscription.version += 1
+            subscription.save(update_fields=[*changed, "version", "updated_at"])
+        else:
+            log.debug(f"Subscription {subscription.pk} unchanged by {event.id} update, not saving")
 
         if subscription.is_active:
             features = _get_features_for_price(event.price_id)
@@ -111,17 +202,9 @@ class HandleSubscriptionDeleted(WebhookHandler):
 
     @classmethod
     def handle(cls, data: dict):
-        event = ensure_valid_subscription_model(data)
+        event = ensure_valid_subscription_model(data, cls.__event__)
 
-        try:
-            subscription = Subscription.objects.select_for_update().get(stripe_subscription_id=event.id)
-        except Subscription.DoesNotExist:
-            raise WebhookSkip(
-                f"Subscription {event.id} not found for delete",
-                context={"stripe_subscription_id": event.id},
-            )
-
-        subscription.cancel()
+        subscription = _transition(event.id, SubscriptionStatus.CANCELED, "delete", canceled_at=timezone.now())
         revoke_for_subscription(subscription, reason="Subscription canceled")
 
 
@@ -130,17 +213,9 @@ class HandleSubscriptionPaused(WebhookHandler):
 
     @classmethod
     def handle(cls, data: dict):
-        event = ensure_valid_subscription_model(data)
-
-        try:
-            subscription = Subscription.objects.select_for_update().get(stripe_subscription_id=event.id)
-        except Subscription.DoesNotExist:
-            raise WebhookSkip(
-                f"Subscription {event.id} not found for pause",
-                context={"stripe_subscription_id": event.id},
-            )
+        event = ensure_valid_subscription_model(data, cls.__event__)
 
-        subscription.pause()
+        subscription = _transition(event.id, SubscriptionStatus.PAUSED, "pause", paused_at=timezone.now())
         revoke_for_subscription(subscription, reason="Subscription paused")
         log.info(f"Paused subscription {subscription.pk}, entitlements revoked")
 
@@ -150,30 +225,16 @@ class HandleSubscriptionResumed(WebhookHandler):
 
     @classmethod
     def handle(cls, data: dict):
-        event = ensure_valid_subscription_model(data)
-
-        try:
-            subscription = Subscription.objects.select_for_update().get(stripe_subscription_id=event.id)
-        except Subscription.DoesNotExist:
-            raise WebhookSkip(
-                f"Subscription {event.id} not found for resume",
-                context={"stripe_subscription_id": event.id},
-            )
-
-        subscription.apply_new_status(SubscriptionStatus.ACTIVE)
-        subscription.resumed_at = timezone.now()
-        subscription.paused_at = None
-        subscription.current_period_start = event.current_period_start_dt
-        subscription.current_period_end = event.current_period_end_dt
-        subscription.save(
-            update_fields=[
-                "status",
-                "resumed_at",
-                "paused_at",
-                "current_period_start",
-                "current_period_end",
-                "updated_at",
-            ]
+        event = ensure_valid_subscription_model(data, cls.__event__)
+
+        subscription = _transition(
+            event.id,
+            SubscriptionStatus.ACTIVE,
+            "resume",
+            resumed_at=timezone.now(),
+            paused_at=None,
+            current_period_start=event.current_period_start_dt,
+            current_period_end=event.current_period_end_dt,
         )
 
         if subscription.is_active:
@@ -1,31 +1,92 @@
 from datetime import timedelta
+from unittest.mock import patch
+
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
-from django.test import TestCase
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from rest_framework.test import APIClient
 
-from subscriptions.models import SubscriptionStatus
-from testing_utils import make_customer, make_subscription, make_user
+from subscriptions.models import Subscription, SubscriptionStatus
+from subscriptions.views import SubscriptionCursorPagination
+from testing_utils import make_customer, make_subscription, make_user, reset_counter
 
 User = get_user_model()
 
 
-class MySubscriptionViewTest(TestCase):
+class SubscriptionTransitionTest(TestCase):
+
+    def test_pause_writes_once(self):
+        sub = make_subscription(customer=make_customer())
+
+        with CaptureQueriesContext(connection) as ctx:
+            sub.pause()
+
+        # the UPDATE, and the re-read of the version it bumped in SQL
+        self.assertEqual(len(ctx.captured_queries), 2)
+        sub.refresh_from_db()
+        self.assertEqual(sub.status, SubscriptionStatus.PAUSED)
+        self.assertIsNotNone(sub.paused_at)
+        self.assertEqual(sub.version, 1)
+
+    def test_cancel_bumps_version_past_concurrent_write(self):
+        sub = make_subscription(customer=make_customer())
+        original_apply = Subscription.apply_new_status
+
+        def apply_with_concurrent_write(instance, new_status):
+            # another writer lands after this instance was loaded
+            Subscription.objects.filter(pk=instance.pk).update(version=F("version") + 1)
+            original_apply(instance, new_status)
+
+        with patch.object(Subscription, "apply_new_status", apply_with_concurrent_write):
+            sub.cancel()
+
+        self.assertEqual(sub.version, 2)
+        sub.refresh_from_db()
+        self.assertEqual(sub.status, SubscriptionStatus.CANCELED)
+        self.assertEqual(sub.version, 2)
 
-    def setUp(self):
-        self.user_a = make_user(email="a@test.com", username="user_a")
-        self.user_b = make_user(email="b@test.com", username="user_b")
-        self.customer_a = make_customer(user=self.user_a, stripe_customer_id="cus_a")
-        self.customer_b = make_customer(user=self.user_b, stripe_customer_id="cus_b")
 
-        self.sub_a = make_subscription(
-            customer=self.customer_a, stripe_subscription_id="sub_a",
+    @override_settings(DATABASE_ROUTERS=["subscriptions.tests.ReplicaReadRouter"])
+    def test_queryset_transition_runs_on_the_write_database(self):
+        sub = make_subscription(customer=make_customer())
+
+        # a read routed to the unknown "replica" alias would raise ConnectionDoesNotExist
+        updated = Subscription.objects.transition(sub.stripe_subscription_id, SubscriptionStatus.PAUSED)
+
+        self.assertEqual(updated._state.db, "default")
+        self.assertEqual(updated.status, SubscriptionStatus.PAUSED)
+        self.assertEqual(updated.version, 1)
+
+
+class ReplicaReadRouter:
+    def db_for_read(self, model, **hints):
+        return "replica"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+class MySubscriptionViewTest(TestCase):
+    # TestCase already builds self.client for every test; make that the APIClient
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        reset_counter()
+        cls.user_a = make_user(email="a@test.com", username="user_a")
+        cls.user_b = make_user(email="b@test.com", username="user_b")
+        cls.customer_a = make_customer(user=cls.user_a, stripe_customer_id="cus_a")
+        cls.customer_b = make_customer(user=cls.user_b, stripe_customer_id="cus_b")
+
+        cls.sub_a = make_subscription(
+            customer=cls.customer_a, stripe_subscription_id="sub_a",
         )
-        self.sub_b = make_subscription(
-            customer=self.customer_b, stripe_subscription_id="sub_b",
+        cls.sub_b = make_subscription(
+            customer=cls.customer_b, stripe_subscription_id="sub_b",
         )
-        self.client: APIClient = APIClient()
 
     def test_returns_only_own_subscriptions(self):
         self.client.force_authenticate(user=self.user_a)
@@ -36,6 +97,16 @@ class MySubscriptionViewTest(TestCase):
         self.assertIn("sub_a", ids)
         self.assertNotIn("sub_b", ids)
 
+    def test_does_not_query_per_row(self):
+        for i in range(3):
+            make_subscription(customer=self.customer_a, stripe_subscription_id=f"sub_a_n{i}")
+        self.client.force_authenticate(user=self.user_a)
+        # page SELECT with customer joined; the user is the request's own
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/subscriptions/me/")
+        self.assertEqual(len(response.data["results"]), 4)
+        self.assertEqual({s["customer_email"] for s in response.data["results"]}, {"a@test.com"})
+
     def test_returns_empty_for_user_with_no_subscriptions(self):
         user_c = make_user(email="c@test.com", username="user_c")
         self.client.force_authenticate(user=user_c)
@@ -49,22 +120,24 @@ class MySubscriptionViewTest(TestCase):
 
 
 class AdminSubscriptionViewSetTest(TestCase):
-    def setUp(self):
-        self.admin = make_user(email="admin@test.com", username="admin")
-        self.regular = make_user(email="regular@test.com", username="regular")
-        self.customer = make_customer(
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        reset_counter()
+        cls.admin = make_user(email="admin@test.com", username="admin")
+        cls.regular = make_user(email="regular@test.com", username="regular")
+        cls.customer = make_customer(
             user=make_user(email="sub@test.com", username="subuser"),
             stripe_customer_id="cus_admin_test",
         )
-        make_subscription(customer=self.customer, stripe_subscription_id="sub_admin")
+        make_subscription(customer=cls.customer, stripe_subscription_id="sub_admin")
 
         perm = Permission.objects.get(
             codename="view_subscription",
             content_type__app_label="subscriptions",
         )
-        self.admin.user_permissions.add(perm)
-
-        self.client: APIClient = APIClient()
+        cls.admin.user_permissions.add(perm)
 
     def test_admin_with_permission_can_list(self):
         self.client.force_authenticate(user=self.admin)
@@ -90,10 +163,58 @@ class AdminSubscriptionViewSetTest(TestCase):
         self.client.force_authenticate(user=self.admin)
 
         response = self.client.get("/api/subscriptions/", {"status": "active"})
+        self.assertEqual(response.status_code, 200, msg=response.content)
         ids = [s["stripe_subscription_id"] for s in response.data["results"]]
         self.assertIn("sub_admin", ids)
         self.assertNotIn("sub_canceled", ids)
 
+    def test_filter_by_status_in(self):
+        make_subscription(
+            customer=self.customer,
+            stripe_subscription_id="sub_paused",
+            status=SubscriptionStatus.PAUSED,
+        )
+        make_subscription(
+            customer=self.customer,
+            stripe_subscription_id="sub_canceled",
+            status=SubscriptionStatus.CANCELED,
+        )
+        self.client.force_authenticate(user=self.admin)
+
+        response = self.client.get("/api/subscriptions/", {"status__in": "active,paused"})
+        ids = {s["stripe_subscription_id"] for s in response.data["results"]}
+        self.assertEqual(ids, {"sub_admin", "sub_paused"})
+
+    def test_list_does_not_query_per_row(self):
+        for i in range(3):
+            make_subscription(
+                customer=make_customer(stripe_customer_id=f"cus_admin_n{i}"),
+                stripe_subscription_id=f"sub_admin_n{i}",
+            )
+        self.client.force_authenticate(user=self.admin)
+        # user + group permissions, page SELECT with customer and user joined (cursor pages need no COUNT)
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/subscriptions/")
+        self.assertEqual(len(response.data["results"]), 4)
+
+    def test_cursor_pages_cover_every_subscription_once(self):
+        for i in range(4):
+            make_subscription(customer=self.customer, stripe_subscription_id=f"sub_admin_p{i}")
+        self.client.force_authenticate(user=self.admin)
+
+        seen, pages = [], 0
+        url = "/api/subscriptions/"
+        with patch.object(SubscriptionCursorPagination, "page_size", 2):
+            while url:
+                response = self.client.get(url)
+                seen += [s["stripe_subscription_id"] for s in response.data["results"]]
+                url = response.data["next"]
+                pages += 1
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
     def test_viewset_is_read_only(self):
         self.client.force_authenticate(user=self.admin)
         response = self.client.post("/api/subscriptions/", {})
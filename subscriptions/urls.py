@@ -6,6 +6,8 @@ from subscriptions.views import SubscriptionViewSet, MySubscriptionView
 app_name = "subscriptions"
 router = DefaultRouter()
 router.include_root_view = False
+# no .json/.api suffix variants; clients negotiate the format with Accept
+router.include_format_suffixes = False
 router.register(r"", SubscriptionViewSet, basename="subscription")
 
 
@@ -1,7 +1,9 @@
 import itertools
 from datetime import timedelta
+from functools import lru_cache
 
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
 from django.utils import timezone
 
 from accounts.models import Customer
@@ -16,11 +18,31 @@ def _next_id():
     return next(_counter)
 
 
+def reset_counter():
+    """
+    Restart generated ids at 1. Call at the top of setUpTestData: every TestCase
+    class rolls back its rows, so ids only need to be unique within a class, and
+    a class then gets the same short ids wherever it runs in the suite.
+    """
+    global _counter
+    _counter = itertools.count(1)
+
+
+@lru_cache(maxsize=None)
+def _hashed_password(password: str) -> str:
+    # a full PBKDF2 run per user dominated fixture setup; the hash is salted once and reused
+    return make_password(password)
+
+
 def make_user(email=None, username=None, password="testpass123"):
     n = _next_id()
     email = email or f"test{n}@example.com"
     username = username or f"testuser{n}"
-    return User.objects.create_user(username=username, email=email, password=password)
+    return User.objects.create(
+        username=username,
+        email=User.objects.normalize_email(email),
+        password=_hashed_password(password),
+    )
 
 
 def make_customer(user=None, stripe_customer_id=None):
@@ -1,2 +1,37 @@
+import threading
+from collections import deque
+from typing import Hashable
+
+
 def filtered_dict(value: dict, key=lambda k, v: v is not None) -> dict:
     return {k: v for k, v in value.items() if key(k, v)}
+
+
+class BoundedSet:
+    """Thread-safe set that keeps only the `maxlen` most recently added items."""
+
+    def __init__(self, maxlen: int):
+        self._items: set = set()
+        self._order: deque = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def __contains__(self, item: Hashable) -> bool:
+        with self._lock:
+            return item in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, item: Hashable) -> None:
+        with self._lock:
+            if item in self._items:
+                return
+            if len(self._order) == self._order.maxlen:
+                self._items.discard(self._order[0])
+            self._order.append(item)
+            self._items.add(item)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._order.clear()
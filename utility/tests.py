@@ -1,6 +1,6 @@
 from django.test import TestCase
 
-from utility.collections import filtered_dict
+from utility.collections import BoundedSet, filtered_dict
 from utility.classes import classproperty
 
 
@@ -27,6 +27,33 @@ class FilteredDictTest(TestCase):
         self.assertEqual(result, {"a": 1, "b": 2})
 
 
+class BoundedSetTest(TestCase):
+
+    def test_contains_added_items(self):
+        s = BoundedSet(maxlen=3)
+        s.add("a")
+        self.assertIn("a", s)
+        self.assertNotIn("b", s)
+
+    def test_evicts_oldest_when_full(self):
+        s = BoundedSet(maxlen=2)
+        s.add("a")
+        s.add("b")
+        s.add("c")
+        self.assertNotIn("a", s)
+        self.assertIn("b", s)
+        self.assertIn("c", s)
+        self.assertEqual(len(s), 2)
+
+    def test_re_adding_does_not_evict(self):
+        s = BoundedSet(maxlen=2)
+        s.add("a")
+        s.add("b")
+        s.add("b")
+        self.assertIn("a", s)
+        self.assertEqual(len(s), 2)
+
+
 class ClasspropertyTest(TestCase):
 
     def test_classproperty_on_class(self):